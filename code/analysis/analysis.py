@@ -20,6 +20,10 @@ from sklearn import preprocessing
 import pickle
 import code
 from joblib import Parallel, delayed
+import columnar
+import normalization
+import spatial_blocks
+import feature_matrix
 pd.options.mode.chained_assignment = 'raise'
 import itertools
 import glob
@@ -106,13 +110,16 @@ def main():
     # # # plot the partial dependence
     # plot_dependence(importance_order, reg_gbm, cities, X_train, vars_selected, show_plot=False)
 
-def import_data(grid_size, selected_vars = True):
+def import_data(grid_size, selected_vars = True, columns = None):
+    '''
+    columns: the columns of the regression data to read (selected_vars = False)
+    '''
     if selected_vars:
         df = pd.read_csv('data/data_vif_{}.csv'.format(grid_size))
         df = df.drop('Unnamed: 0', axis=1)
     else:
-        df = pd.read_csv('data/data_regressions_{}_20200303.csv'.format(grid_size))
-        df = df.drop('Unnamed: 0', axis=1)
+        # columnar dataset from prepare_data
+        df = columnar.read_columns('data/data_regressions_{}'.format(grid_size), columns)
     return(df)
 
 
@@ -124,28 +131,33 @@ def regressions(df, cities, sim_num, grid_size, do_par = False):
     # for city in cities:
     df_city = df#[df['city']==city] #df_city = df.loc[df['city']==city]
     predict_quant = 'lst'
-    df_city, response = prepare_lst_prediction(df_city)
+    # the features and responses as arrays, converted once for all the holdouts
+    data = feature_matrix.FeatureMatrix(df_city)
+    # one splitter for all the holdouts, which counts the rows of each block once
+    splitter = spatial_blocks.SpatialHoldout(test_size=0.20)
+    splitter.block_sizes(data.groups)
     # conduct the holdout
     if do_par:
-        Parallel(n_jobs=CORES_NUM)(delayed(single_regression)(df_city, response, grid_size, predict_quant, i) for i in range(93,sim_num))
+        Parallel(n_jobs=CORES_NUM)(delayed(single_regression)(data, grid_size, predict_quant, i, splitter) for i in range(93,sim_num))
     else:
         for i in range(sim_num):
-            single_regression(df_city, response, grid_size, predict_quant, i)
+            single_regression(data, grid_size, predict_quant, i, splitter)
 
 
-def single_regression(df_city, response, grid_size, predict_quant, i):
+def single_regression(data, grid_size, predict_quant, i, splitter=None):
     '''
     fit the different models for a single holdout
+    data: the FeatureMatrix of the regression data
+    splitter: the SpatialHoldout shared by the holdouts (default: a new one)
     '''
     city = str(i)
     # prepare the results of the holdout
     loss = pd.DataFrame()
     # divide into test and training sets
-    X_train, X_test, y_train, y_test = split_holdout(df_city, response, test_size=0.20)#, random_state=RANDOM_SEED)
-    # drop unnecessary variables
-    X_train, X_test = subset_regression_data(X_train, X_test)
-    # response values
-    y = define_response_lst(y_train, y_test)
+    if splitter is None:
+        splitter = spatial_blocks.SpatialHoldout(test_size=0.20)
+    train, test = splitter.holdout(data.groups, random_state=RANDOM_SEED + i)
+    X_train, X_test, y = data.split(train, test)
     # null model
     loss = regression_null(y, city, predict_quant, loss)
     # GradientBoostingRegressor
@@ -169,21 +181,12 @@ def regression_cityholdouts(df, cities):
     '''
     predict_quant = 'lst'
 
-    # prep y
-    df, response = prepare_lst_prediction(df)
+    # the features and responses as arrays
+    data = feature_matrix.FeatureMatrix(df)
     loss = pd.DataFrame()
     for city in cities:
-        train_idx = np.where(df['city'] != city)
-        test_idx = np.where(df['city'] == city)
         # divide into test and training sets
-        X_train = df.iloc[train_idx].copy()
-        y_train = response.iloc[train_idx].copy()
-        X_test = df.iloc[test_idx].copy()
-        y_test = response.iloc[test_idx].copy()
-        # drop unnecessary variables
-        X_train, X_test = subset_regression_data(X_train, X_test)
-        # response values
-        y = define_response_lst(y_train, y_test)
+        X_train, X_test, y = data.split(np.flatnonzero(data.city != city), np.flatnonzero(data.city == city))
         ### do the holdouts
         city = 'hold-{}'.format(city)
         # null model
@@ -222,7 +225,7 @@ def subset_regression_data(X_train, X_test):
     cities = np.unique(X_train['city'])
 
     # drop the following variables
-    vars_drop = ['city','holdout','x','y']
+    vars_drop = ['city','x','y'] + [i for i in vars_all if i.startswith('holdout')]
     X_train = X_train.drop(vars_drop, axis=1)
     X_test = X_test.drop(vars_drop, axis=1)
 
@@ -251,39 +254,44 @@ def calculate_partial_dependence(df, grid_size, boot_index = None):
     predict the target variable to see how it is influenced by the feature
     '''
     results_partial = pd.DataFrame()
-    df, target = prepare_lst_prediction(df)
-    df  = subset_regression_data(df, df)[0]
-    df_reference = df.copy()
+    # the features and responses as arrays
+    data = feature_matrix.FeatureMatrix(df)
+    X = data.X
+    # mars, gam and the linear model are fitted and predict in float64
+    X_64 = X.astype(np.float64)
     feature_resolution = 25
     # loop day and night
     for h in ['lst_day_mean', 'lst_night_mean', 'lst_night_max','lst_day_max']:
         print(h)
+        target = data.response[h]
         ###
         # fit models
         ###
         # gradient boosted tree
         gbm = GradientBoostingRegressor(max_depth=2, random_state=RANDOM_SEED, learning_rate=0.1, n_estimators=500, loss='ls')
-        gbm.fit(df, target[h])
+        gbm.fit(X, target)
         # random forest
         rf = RandomForestRegressor(random_state=RANDOM_SEED, n_estimators=500, max_features=1/3)
-        rf.fit(df, target[h])
+        rf.fit(X, target)
         # mars
         mars = Earth(max_degree=1, penalty=1.0, endspan=5)
-        mars.fit(df, target[h])
+        mars.fit(X_64, target)
         # GAM
-        gam = LinearGAM(n_splines=10).fit(df, target[h])
+        gam = LinearGAM(n_splines=10).fit(X_64, target)
         # linear
         mlr = LinearRegression()
-        mlr = mlr.fit(df, target[h])
+        mlr = mlr.fit(X_64, target)
         ###
         # loop through features and their ranges
         ###
-        for var_interest in list(df): #['tree_mean','density_housesarea']:
+        for j, var_interest in enumerate(data.features): #['tree_mean','density_housesarea']:
             # loop through range of var_interest
-            var_values = np.linspace(np.percentile(df[var_interest],2.5),np.percentile(df[var_interest],97.5), feature_resolution)
-            df_change = df.copy()
+            var_values = np.linspace(np.percentile(X[:, j],2.5),np.percentile(X[:, j],97.5), feature_resolution)
+            df_change = X.copy()
+            df_change_64 = X_64.copy()
             for x in var_values:
-                df_change[var_interest] = x
+                df_change[:, j] = x
+                df_change_64[:, j] = x
                 # gbm
                 pred = gbm.predict(df_change)
                 # save results
@@ -295,17 +303,17 @@ def calculate_partial_dependence(df, grid_size, boot_index = None):
                 results_partial = results_partial.append({'model': 'rf', 'dependent':h,'independent':var_interest,
                                                           'x':x, 'mean':np.mean(pred), 'boot': boot_index}, ignore_index=True)
                 # mars
-                pred = mars.predict(df_change)
+                pred = mars.predict(df_change_64)
                 # save results
                 results_partial = results_partial.append({'model': 'mars', 'dependent':h,'independent':var_interest,
                                                           'x':x, 'mean':np.mean(pred), 'boot': boot_index}, ignore_index=True)
                 # gam
-                pred = gam.predict(df_change)
+                pred = gam.predict(df_change_64)
                 # save results
                 results_partial = results_partial.append({'model': 'gam', 'dependent':h,'independent':var_interest,
                                                           'x':x, 'mean':np.mean(pred), 'boot': boot_index}, ignore_index=True)
                 # mlr
-                pred = mlr.predict(df_change)
+                pred = mlr.predict(df_change_64)
                 # save results
                 results_partial = results_partial.append({'model': 'mlr', 'dependent':h,'independent':var_interest,
                                                           'x':x, 'mean':np.mean(pred), 'boot': boot_index}, ignore_index=True)
@@ -364,11 +372,8 @@ def bootstrap_main(df, grid_size, boot_num, do_par = False):
     df_from_each_file = (pd.read_csv(f) for f in all_files)
     results_pd = pd.concat(df_from_each_file, ignore_index=True)
     # undo the normalization
-    normalize_parameters = pd.read_csv('data/normalization_parameters_{}.csv'.format(grid_size))
-    normalize_parameters = normalize_parameters.set_index('feature')
-    for index, row in results_pd.iterrows():
-        feature = row.independent
-        results_pd.loc[index,'x'] = row['x']*normalize_parameters.loc[feature,'sd'] + normalize_parameters.loc[feature,'mean']
+    scaler = normalization.load_scaler(grid_size)
+    results_pd = scaler.inverse_transform_long(results_pd, 'x', 'independent')
 
     # save results
     results_pd.to_csv('data/regression/results_partial_dependents_{}.csv'.format(grid_size))
@@ -573,6 +578,9 @@ def regression_linear(X_train, y, X_test, city, predict_quant, loss):
     mlr_night_reg = LinearRegression()
     reg_daymax = LinearRegression()
     reg_nightmax = LinearRegression()
+    # in float64, as before the float32 feature matrix
+    X_train = np.asarray(X_train, dtype=np.float64)
+    X_test = np.asarray(X_test, dtype=np.float64)
 
     mlr_day_reg.fit(X_train, y['day_train'])
     mlr_night_reg.fit(X_train, y['night_train'])
@@ -639,6 +647,9 @@ def regression_mars(X_train, y, X_test, city, predict_quant, loss):
     reg_night = Earth(max_degree=1, penalty=1.0, endspan=5)
     reg_nightmax = Earth(max_degree=1, penalty=1.0, endspan=5)
     reg_daymax = Earth(max_degree=1, penalty=1.0, endspan=5)
+    # as float64 once, rather than in each fit and predict
+    X_train = np.asarray(X_train, dtype=np.float64)
+    X_test = np.asarray(X_test, dtype=np.float64)
     reg_day.fit(X_train, y['day_train'])
     reg_night.fit(X_train, y['night_train'])
     reg_daymax.fit(X_train, y['daymax_train'])
@@ -671,6 +682,9 @@ def regression_gam(X_train, y, X_test, city, predict_quant, loss):
     reg_night = LinearGAM(n_splines=10)
     reg_nightmax = LinearGAM(n_splines=10)
     reg_daymax = LinearGAM(n_splines=10)
+    # as float64 once, rather than in each fit and predict
+    X_train = np.asarray(X_train, dtype=np.float64)
+    X_test = np.asarray(X_test, dtype=np.float64)
     reg_day.fit(X_train, y['day_train'])
     reg_night.fit(X_train, y['night_train'])
     reg_daymax.fit(X_train, y['daymax_train'])
@@ -714,16 +728,17 @@ def full_gbm_regression(df, cities, vars_selected=None):
             df_city = df.copy()
         # drop necessary variables
         df_city, response = prepare_lst_prediction(df_city)
+        holdout_groups = df_city['holdout'].values
         # keep only specified variables, if any were specified
         if len(vars_selected)>0:
             df_city = df_city[vars_selected+['city']]
         # no need to divide, but split into X and y
-        X_train[city], X_test, y_train, y_test = split_holdout(df_city, response, test_size=0)#, random_state=RANDOM_SEED)
-        print(len(X_train[city]), len(X_test))
+        train, test = split_holdout(holdout_groups, test_size=0)#, random_state=RANDOM_SEED)
+        print(len(train), len(test))
         # drop unnecessary variables
-        X_train, X_test = subset_regression_data(X_train, X_test)
+        X_train[city], X_test = subset_regression_data(df_city.iloc[train], df_city.iloc[test])
         # response values
-        y = define_response_lst(y_train, y_train)
+        y = define_response_lst(response.iloc[train], response.iloc[train])
         # fit the model
         reg_gbm['diurnal'][city] = GradientBoostingRegressor(max_depth=2, learning_rate=0.1, n_estimators=500, loss='ls')
         reg_gbm['diurnal'][city].fit(X_train[city], y['day_train'])
@@ -765,36 +780,18 @@ def calculate_errors(y, predict_day, predict_night, predict_daymax, predict_nigh
 # Supporting code
 ###
 
-def split_holdout(df_arg, response, test_size):
+def split_holdout(groups, test_size, random_state=None, splitter=None):
     '''
     Prepare spatial holdout
+    groups: the spatial block of each row (e.g. df.holdout.values, or another
+        blocking of prepare_data.BLOCKINGS such as holdout_hex_8)
+    random_state: seed of the split (default: numpy's global random state)
+    splitter: a SpatialHoldout of test_size to reuse, so the blocks of the groups are counted once
+    returns the integer indices of the training and test rows
     '''
-    df = df_arg.copy()
-    # what is the total number of records?
-    n_records = df.shape[0]
-    # what are the holdout numbers to draw from?
-    holdout_freq = df.groupby('holdout')['holdout'].count()
-    holdout_options = list(holdout_freq.index)
-    # required number of records
-    req_records = n_records * (test_size*0.95)
-    # select holdout groups until required number of records is achieved
-    heldout_records = 0
-    heldout_groups = []
-    while heldout_records < req_records:
-        # randomly select a holdout group to holdout
-        hold = np.random.choice(holdout_options, 1, replace = False)[0]
-        # remove that from the options
-        holdout_options.remove(hold)
-        # add that to the heldout list
-        heldout_groups.append(hold)
-        # calculate the number of records held out
-        heldout_records = holdout_freq.loc[heldout_groups].sum()
-    # create the test and training sets
-    X_test = df[df.holdout.isin(heldout_groups)]
-    y_test = response[df.holdout.isin(heldout_groups)]
-    X_train = df[~df.holdout.isin(heldout_groups)]
-    y_train = response[~df.holdout.isin(heldout_groups)]
-    return(X_train, X_test, y_train, y_test)
+    if splitter is None:
+        splitter = spatial_blocks.SpatialHoldout(test_size)
+    return(splitter.holdout(groups, random_state=random_state))
 
 def loop_variable_selection(df, cities):
     from datetime import datetime
@@ -823,6 +820,11 @@ def feature_selection(holdout_num, city, df, period):
         df_city = df.copy()
     # drop necessary variables
     df_city, response = prepare_lst_prediction(df_city)
+    # the same holdouts for each variable, drawn once
+    splitter = spatial_blocks.SpatialHoldout(test_size=0.25)
+    splits = [split_holdout(df_city['holdout'].values, 0.25, random_state=RANDOM_SEED + h, splitter=splitter)
+        for h in range(holdout_num)]
+    target = response[feature_matrix.RESPONSES[period]].values
     # add variables based on which provide the best improvement to lowering MAE
     vars_inc = []
     vars_mae = []
@@ -832,23 +834,19 @@ def feature_selection(holdout_num, city, df, period):
         variables = [var for var in variables if var not in vars_inc]
         variable_mae = pd.DataFrame(index=variables, columns=['mae'])
         for var in variables:
-            df_var = df_city.loc[:,[var,'city'] + vars_inc].copy()
+            # the features, without the unnecessary variables (as subset_regression_data)
+            features = [i for i in [var] + vars_inc if i not in ['x','y'] and not i.startswith('holdout')]
+            X_var = df_city[features].values
             # initialize error measures
             mae = []
-            for h in range(holdout_num):
-                # no need to divide, but split into X and y
-                X_train, X_test, y_train, y_test = split_holdout(df_var, response, test_size=0.25)#, random_state=RANDOM_SEED)
-                # drop unnecessary variables
-                X_train, X_test = subset_regression_data(X_train.copy(), X_test.copy())
-                # response values
-                y = define_response_lst(y_train, y_test)
+            for train, test in splits:
                 # fit the model
                 gbm_day = GradientBoostingRegressor(max_depth=2, random_state=RANDOM_SEED, learning_rate=0.1, n_estimators=500, loss='ls')
-                gbm_day.fit(X_train, y['{}_train'.format(period)])
+                gbm_day.fit(X_var[train], target[train])
                 # predict the model
-                predict_day = gbm_day.predict(X_test)
+                predict_day = gbm_day.predict(X_var[test])
                 # calculate MAE
-                mae.append(np.mean(abs(predict_day - y['{}_test'.format(period)])))
+                mae.append(np.mean(abs(predict_day - target[test])))
             # calculate the average
             variable_mae.loc[var,'mae'] = np.mean(mae)
         # variable to include
@@ -1229,11 +1227,8 @@ def plot_dependence_city(grid_size):
     # import data
     pdp_results = pd.read_csv('data/regression/city_{}/results_partial_dependence_{}.csv'.format(grid_size, grid_size))
     # undo the normalization
-    normalize_parameters = pd.read_csv('data/normalization_parameters_{}.csv'.format(grid_size))
-    normalize_parameters = normalize_parameters.set_index('feature')
-    for index, row in pdp_results.iterrows():
-        feature = row.independent
-        pdp_results.loc[index,'x'] = row['x']*normalize_parameters.loc[feature,'sd'] + normalize_parameters.loc[feature,'mean']
+    scaler = normalization.load_scaler(grid_size)
+    pdp_results = scaler.inverse_transform_long(pdp_results, 'x', 'independent')
     # humanize the names
     pdp_results = pdp_results.replace(feature_names)
     pdp_results = pdp_results.replace(model_names)
@@ -1375,8 +1370,7 @@ def plot_2d_partialdependence(regressor, time_of_day, grid_size, df_x):
     else:
         features = [(0,6),(0,8),(1,6),(1,8),(2,6),(2,8)]
     # import data to unnormalize
-    normalize_parameters = pd.read_csv('data/normalization_parameters_{}.csv'.format(grid_size))
-    normalize_parameters = normalize_parameters.set_index('feature')
+    scaler = normalization.load_scaler(grid_size)
 
     for i in range(len(features)):
         plot_row = floor(i/2)
@@ -1390,8 +1384,8 @@ def plot_2d_partialdependence(regressor, time_of_day, grid_size, df_x):
         # unnormalize
         feature_x = df_vars[features[i][0]]
         feature_y = df_vars[features[i][1]]
-        XX = XX*normalize_parameters.loc[feature_x,'sd'] + normalize_parameters.loc[feature_x,'mean']
-        YY = YY*normalize_parameters.loc[feature_y,'sd'] + normalize_parameters.loc[feature_y,'mean']
+        XX = scaler.inverse_values(XX, feature_x)
+        YY = scaler.inverse_values(YY, feature_y)
 
         # add the line to the plot
         CS = axes[plot_row, left_right].contour(XX,YY,Z)#, levels=np.arange(-8,4,1))
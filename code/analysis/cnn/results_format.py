@@ -1,4 +1,7 @@
 import pandas as pd
+import sys
+sys.path.append('code/analysis')
+import normalization
 
 responses = ['lst_day_mean', 'lst_night_mean','lst_day_max', 'lst_night_max']
 
@@ -8,8 +11,7 @@ def pdp_results(grid_size):
     '''
     results_partial = pd.DataFrame()
     # import normalization data
-    normalize_parameters = pd.read_csv('data/normalization_parameters_{}.csv'.format(grid_size))
-    normalize_parameters = normalize_parameters.set_index('feature')
+    scaler = normalization.load_scaler(grid_size)
 
     # import results
     for h in responses:
@@ -22,7 +24,7 @@ def pdp_results(grid_size):
         for feature in features:
             df_feature = result_cnn[['x_' + feature, 'y_' + feature, 'i_holdout']]
             # unnormalize the feature
-            df_feature['x_' + feature] = df_feature['x_' + feature].copy()*normalize_parameters.loc[feature,'sd'] + normalize_parameters.loc[feature,'mean']
+            df_feature['x_' + feature] = scaler.inverse_values(df_feature['x_' + feature].copy(), feature)
             # rename columns
             df_feature['x'] = df_feature['x_' + feature]
             df_feature['mean'] = df_feature['y_' + feature]
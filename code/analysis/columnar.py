@@ -0,0 +1,151 @@
+'''
+Columnar storage of the regression data
+
+A dataset is a directory with a .npy file for each column and schema.json,
+which lists the columns in order with their dtype (and the categories of the
+categorical columns). The schema is explicit
+        float32: the features and responses
+        category: city (int8 codes)
+        float64: the coordinates x/y (projected, so float32 would round them)
+        int64: the holdout columns
+Only the columns asked for are read, from the page cache rather than by
+parsing text. read_array returns a column's memory-mapped array itself, while
+read_columns copies the columns into a dataframe
+export_csv saves a dataset as a csv, for the notebooks (explore_data.ipynb,
+partial_dependence_R.ipynb) which read the regression data that way
+'''
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+SCHEMA = 'schema.json'
+CATEGORICAL_COLUMNS = ['city']
+COORDINATE_COLUMNS = ['x', 'y']
+
+
+def column_dtype(name, values):
+    '''
+        The stored dtype of the column
+    '''
+    if name in CATEGORICAL_COLUMNS or not np.issubdtype(values.dtype, np.number):
+        return('category')
+    if name.startswith('holdout'):
+        return('int64')
+    if name in COORDINATE_COLUMNS:
+        return('float64')
+    return('float32')
+
+
+def write_columns(df, path):
+    '''
+        Save the dataframe as a columnar dataset in the directory path
+    '''
+    columns = list()
+    for name in df.columns:
+        values = df[name].values
+        dtype = column_dtype(name, values)
+        if dtype == 'category':
+            values = pd.Categorical(values)
+            columns.append((name, dtype, [str(c) for c in values.categories]))
+        else:
+            columns.append((name, dtype, None))
+    arrays = create_columns(path, columns, len(df))
+    for name, dtype, categories in columns:
+        arrays[name][:] = encode(df[name].values, dtype, categories)
+        arrays[name].flush()
+
+
+def create_columns(path, columns, n_rows):
+    '''
+        Create an empty columnar dataset in the directory path, to be filled in
+        (e.g. a chunk of rows at a time)
+        columns: list of (name, dtype, categories), with categories None unless
+            the dtype is category
+        Return
+            Dictionary of the column name to its writable memory-mapped array
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    schema = list()
+    arrays = dict()
+    for name, dtype, categories in columns:
+        column = dict(name=name, dtype=dtype, file='{}.npy'.format(len(schema)))
+        if dtype == 'category':
+            column['categories'] = list(categories)
+        arrays[name] = np.lib.format.open_memmap(os.path.join(path, column['file']), mode='w+',
+            dtype=np.int8 if dtype == 'category' else dtype, shape=(n_rows,))
+        schema.append(column)
+    with open(os.path.join(path, SCHEMA), 'w') as fid:
+        json.dump(dict(columns=schema, n_rows=n_rows), fid, indent=1)
+    return(arrays)
+
+
+def encode(values, dtype, categories=None):
+    '''
+        The values as stored: the codes of the categories, or cast to the dtype
+    '''
+    if dtype == 'category':
+        return(pd.Categorical(values, categories=categories).codes.astype(np.int8))
+    return(values.astype(dtype))
+
+
+def read_schema(path):
+    '''
+        The schema of the dataset
+    '''
+    with open(os.path.join(path, SCHEMA), 'r') as fid:
+        return(json.load(fid))
+
+
+def read_array(path, name, mmap_mode='r'):
+    '''
+        The memory-mapped array of a column (the codes, if it is categorical)
+    '''
+    column = [c for c in read_schema(path)['columns'] if c['name'] == name]
+    if not column:
+        raise KeyError('{} is not a column of {}'.format(name, path))
+    return(np.load(os.path.join(path, column[0]['file']), mmap_mode=mmap_mode))
+
+
+def read_columns(path, columns=None, mmap_mode='r'):
+    '''
+        Read the dataset (the columns are copied into the dataframe - use read_array
+        for a column without copying it)
+        columns: the columns to read (default: all)
+        Return
+            Dataframe
+    '''
+    schema = read_schema(path)['columns']
+    if columns is not None:
+        missing = set(columns) - set(c['name'] for c in schema)
+        if missing:
+            raise KeyError('{} are not columns of {}'.format(sorted(missing), path))
+        schema = [c for c in schema if c['name'] in columns]
+    data = dict()
+    for column in schema:
+        values = np.load(os.path.join(path, column['file']), mmap_mode=mmap_mode)
+        if column['dtype'] == 'category':
+            values = pd.Categorical.from_codes(values, column['categories'])
+        data[column['name']] = values
+    return(pd.DataFrame(data, columns=[c['name'] for c in schema]))
+
+
+def export_csv(path, fn_csv, chunk_rows=10**6):
+    '''
+        Save the dataset as a csv with a row index, as prepare_data saved the
+        regression data before the columnar dataset, a chunk of rows at a time
+    '''
+    schema = read_schema(path)
+    arrays = [(column, np.load(os.path.join(path, column['file']), mmap_mode='r')) for column in schema['columns']]
+    for start in range(0, max(schema['n_rows'], 1), chunk_rows):
+        stop = min(start + chunk_rows, schema['n_rows'])
+        data = dict()
+        for column, values in arrays:
+            values = values[start:stop]
+            if column['dtype'] == 'category':
+                values = pd.Categorical.from_codes(values, column['categories'])
+            data[column['name']] = values
+        chunk = pd.DataFrame(data, columns=[c['name'] for c, v in arrays], index=np.arange(start, stop))
+        chunk.to_csv(fn_csv, mode='w' if start == 0 else 'a', header=start == 0)
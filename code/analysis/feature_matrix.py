@@ -0,0 +1,67 @@
+'''
+The regression data as arrays, for fitting the models
+
+FeatureMatrix holds the features once as a contiguous float32 array (the dtype
+the tree models fit with) with the list of feature names as its column index,
+and each response as a float64 vector. The training and test sets are taken
+from it by integer row index, so the frame is not dropped, copied and converted
+to an array again for every model's fit and predict
+'''
+
+import numpy as np
+
+# the responses, by the keys of analysis.define_response_lst
+RESPONSES = {'day': 'lst_day_mean', 'night': 'lst_night_mean',
+    'nightmax': 'lst_night_max', 'daymax': 'lst_day_max'}
+# the columns which are not features (as dropped by analysis.subset_regression_data)
+ID_COLUMNS = ['city', 'x', 'y']
+
+
+class FeatureMatrix(object):
+    '''
+        The features and responses of the regression data
+    '''
+
+    def __init__(self, df, features=None):
+        '''
+            df: the regression data (import_data), with the responses
+            features: the feature columns (default: all but the responses, ids and holdouts)
+        '''
+        if features is None:
+            features = [i for i in df.columns if i not in ID_COLUMNS and not i.startswith('holdout')
+                and i not in RESPONSES.values()]
+        self.features = list(features)
+        self.X = np.ascontiguousarray(df[self.features].values, dtype=np.float32)
+        self.response = {column: np.ascontiguousarray(df[column].values, dtype=np.float64)
+            for column in RESPONSES.values() if column in df.columns}
+        self.groups = df['holdout'].values if 'holdout' in df.columns else None
+        self.city = df['city'].values if 'city' in df.columns else None
+
+    def __len__(self):
+        return(self.X.shape[0])
+
+    def column(self, feature):
+        '''
+            The column index of the feature
+        '''
+        return(self.features.index(feature))
+
+    def rows(self, index):
+        '''
+            The features of the rows: a view if they are a contiguous range, else a copy
+        '''
+        index = np.asarray(index)
+        if len(index) and index[-1] - index[0] == len(index) - 1 and np.all(np.diff(index) == 1):
+            return(self.X[index[0]:index[-1] + 1])
+        return(self.X.take(index, axis=0))
+
+    def split(self, train, test):
+        '''
+            The training and test features, and the responses (as define_response_lst)
+            train, test: integer row indices
+        '''
+        y = dict()
+        for key, column in RESPONSES.items():
+            y['{}_train'.format(key)] = self.response[column][train]
+            y['{}_test'.format(key)] = self.response[column][test]
+        return(self.rows(train), self.rows(test), y)
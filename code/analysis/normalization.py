@@ -0,0 +1,102 @@
+'''
+Standardization of the features between the cities
+
+FeatureScaler is fitted to the regression data in prepare_data (mean and
+standard deviation of each feature) and saved to
+data/normalization_parameters_{grid_size}.pkl, alongside the csv of the
+parameters. The analysis and the results formatting load it to undo the
+standardization of whole columns, including the long results tables with a
+column naming the feature of each row
+'''
+
+import pickle
+import pandas as pd
+
+PARAMETERS = 'data/normalization_parameters_{}'
+
+
+class FeatureScaler(object):
+    '''
+        Standardize each feature to mean 0 and standard deviation 1
+    '''
+
+    def __init__(self):
+        self.parameters = None
+
+    def fit(self, df, features):
+        '''
+            The mean, sd (population), max and min of each feature
+        '''
+        values = df[features]
+        self.parameters = pd.DataFrame({'mean': values.mean(), 'sd': values.std(ddof=0),
+            'max': values.max(), 'min': values.min()}, columns=['mean', 'sd', 'max', 'min'])
+        self.parameters.index.name = 'feature'
+        return(self)
+
+    @property
+    def features(self):
+        return(list(self.parameters.index))
+
+    def transform(self, df):
+        '''
+            Standardize the features of the dataframe
+        '''
+        df = df.copy()
+        features = [f for f in self.features if f in df.columns]
+        df[features] = (df[features] - self.parameters['mean'][features]) / self.parameters['sd'][features]
+        return(df)
+
+    def fit_transform(self, df, features):
+        return(self.fit(df, features).transform(df))
+
+    def inverse_transform(self, df):
+        '''
+            Undo the standardization of the features of the dataframe
+        '''
+        df = df.copy()
+        features = [f for f in self.features if f in df.columns]
+        df[features] = df[features] * self.parameters['sd'][features] + self.parameters['mean'][features]
+        return(df)
+
+    def inverse_values(self, values, feature):
+        '''
+            Undo the standardization of an array of the feature's values
+        '''
+        return(values * self.parameters.loc[feature, 'sd'] + self.parameters.loc[feature, 'mean'])
+
+    def inverse_transform_long(self, df, value='x', feature='independent'):
+        '''
+            Undo the standardization of the value column of a long table, where the
+            feature column names the feature of each row (e.g. the partial dependence results)
+        '''
+        unknown = set(df[feature].unique()) - set(self.features)
+        if unknown:
+            raise KeyError('No normalization parameters for {}'.format(sorted(unknown)))
+        df = df.copy()
+        sd = df[feature].map(self.parameters['sd']).values
+        mean = df[feature].map(self.parameters['mean']).values
+        df[value] = df[value].values * sd + mean
+        return(df)
+
+    def save(self, grid_size):
+        '''
+            Pickle the scaler, and save its parameters as a csv
+        '''
+        with open(PARAMETERS.format(grid_size) + '.pkl', 'wb') as fid:
+            pickle.dump(self, fid)
+        self.parameters.reset_index().to_csv(PARAMETERS.format(grid_size) + '.csv')
+
+
+def load_scaler(grid_size):
+    '''
+        The scaler fitted by prepare_data (from the csv of the parameters, if it
+        was saved before the scaler was)
+    '''
+    try:
+        with open(PARAMETERS.format(grid_size) + '.pkl', 'rb') as fid:
+            return(pickle.load(fid))
+    except FileNotFoundError:
+        scaler = FeatureScaler()
+        parameters = pd.read_csv(PARAMETERS.format(grid_size) + '.csv').set_index('feature')
+        scaler.parameters = parameters[['mean', 'sd', 'max', 'min']]
+        return(scaler)
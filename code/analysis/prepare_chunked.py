@@ -0,0 +1,241 @@
+'''
+Prepare the regression data in row chunks, for grids too large to fit in memory
+(e.g. 50m or 30m grids of larger metro extents)
+
+The output is that of prepare_data.main, using its functions on each chunk.
+Each city's grid csv is read a chunk of rows at a time
+        pass 1: the fraction of nulls of each column in the rows kept (filter_city),
+                which decides the city's columns (city_columns)
+        pass 2: the count, mean, sum of squared deviations (m2), min and max of each
+                column in the rows kept, and their coordinates (for the holdout blocks)
+From these mergeable statistics come the city means (centre_city), the max land
+cover area (adjust_variables), the scaler (scaling_all) and the columns without
+nulls. Then
+        pass 3: each chunk is transformed and written straight into the columnar
+                dataset, which is created at its final size
+Only the coordinates of all the rows are held in memory
+'''
+
+import time
+import numpy as np
+import pandas as pd
+import spatial_blocks
+import columnar
+import normalization
+import prepare_data
+
+CHUNK_ROWS = 10**6
+MOMENTS = ['count', 'mean', 'm2', 'min', 'max']
+# the moments of the building area as a percent of the cell's area (adjust_columns)
+BLDG_AREA = '_bldg_area'
+
+
+def main(scale=True, grid_size=50, chunk_rows=CHUNK_ROWS):
+    '''
+        Prepare the grids of the cities at grid_size in chunks of chunk_rows
+    '''
+    cities = ['bal','det','phx','por']
+    dir_date = '2020-03-01'
+    fn_cities = [(city, 'data/processed/grid/{}/{}/{}_data_{}.csv'.format(city, dir_date, city, grid_size))
+        for city in cities]
+    if scale:
+        path = 'data/data_regressions_{}'.format(grid_size)
+        fn_csv = 'data/data_regressions_{}_{}.csv'.format(grid_size, time.strftime("%Y%m%d"))
+    else:
+        path = 'data/data_regressions_{}_unnormalized'.format(grid_size)
+        fn_csv = 'data/data_regressions_{}_{}_unnormalized.csv'.format(grid_size, time.strftime("%Y%m%d"))
+    prepare_chunked(fn_cities, path, grid_size, scale, chunk_rows)
+    # the csv, for the notebooks (as prepare_data)
+    columnar.export_csv(path, fn_csv, chunk_rows)
+
+
+def prepare_chunked(fn_cities, path, grid_size, scale=True, chunk_rows=CHUNK_ROWS,
+        blockings=prepare_data.BLOCKINGS):
+    '''
+        Prepare the cities' grids into the columnar dataset at path
+        fn_cities: list of (city, grid csv)
+    '''
+    # passes 1 and 2: the columns, statistics and holdout blocks of each city
+    cities = list()
+    add_index = dict()
+    for city, fn_city in fn_cities:
+        columns = city_columns(fn_city, city, chunk_rows)
+        info = city_statistics(fn_city, city, columns, scale, chunk_rows)
+        blocks = pd.DataFrame({column: spatial_blocks.assign_blocks(info['x'], info['y'], **blocking)
+            for column, blocking in blockings.items()})
+        info['blocks'], add_index = prepare_data.offset_holdouts(blocks, add_index, blockings)
+        info.update(city=city, fn_city=fn_city, columns=columns,
+            output_columns=[i for i in columns if 'lst' not in i or i in prepare_data.VARS_RESPONSE] + list(blockings))
+        cities.append(info)
+
+    # the columns of the concatenated cities (sorted, as by pd.concat, unless they all match)
+    union = cities[0]['output_columns']
+    if any(info['output_columns'] != union for info in cities):
+        union = sorted(set(i for info in cities for i in info['output_columns']))
+    vars_lcov = [i for i in union if 'lcov' in i]
+    # the max area of a cell (land cover which is missing in a city is 0)
+    area_max = np.max([info['moments'].loc[i, 'max'] if i in info['moments'].index else 0
+        for info in cities for i in vars_lcov])
+    adjusted = [i for i in union if not ('lcov' in i and '11' not in i) and not (scale and 'imp' in i)
+        and i != 'area']
+
+    # the scaler of the features across the cities
+    vars_indep = [i for i in adjusted if 'lst' not in i and i not in ['x','y','city'] and not i.startswith('holdout')]
+    scaler = None
+    if scale:
+        moments = None
+        for info in cities:
+            moments = merge_moments(moments, feature_moments(info, vars_indep, area_max))
+        scaler = normalization.FeatureScaler()
+        scaler.parameters = pd.DataFrame({'mean': moments['mean'], 'sd': np.sqrt(moments['m2'] / moments['count']),
+            'max': moments['max'], 'min': moments['min']}, columns=['mean', 'sd', 'max', 'min']).loc[vars_indep]
+        scaler.parameters.index.name = 'feature'
+        scaler.save(grid_size)
+
+    # drop the columns with nulls: those missing in a city, or without variance
+    n_rows = sum(info['n_rows'] for info in cities)
+    output = list()
+    for column in adjusted:
+        n_null = sum(info['n_rows'] for info in cities if column not in info['output_columns'] and 'lcov' not in column)
+        if scale and column in vars_indep and not scaler.parameters.loc[column, 'sd'] > 0:
+            n_null = n_rows
+        if n_null / n_rows < .00001:
+            output.append(column)
+
+    # pass 3: transform and write the chunks
+    coords = {i: np.concatenate([info[i] for info in cities]) for i in ['x', 'y']}
+    schema = list()
+    for column in output:
+        if column == 'city':
+            schema.append((column, 'category', sorted(info['city'] for info in cities)))
+        elif column in coords:
+            schema.append((column, columnar.column_dtype(column, coords[column]), None))
+        else:
+            schema.append((column, 'int64' if column.startswith('holdout') else 'float32', None))
+    arrays = columnar.create_columns(path, schema, n_rows)
+    row = 0
+    for info in cities:
+        start = 0
+        for chunk in read_chunks(info['fn_city'], info['city'], chunk_rows):
+            chunk = chunk[info['columns']].dropna(axis='index', how='any')
+            chunk = prepare_data.centre_city(chunk, info['means'], scale)
+            for column in blockings:
+                chunk[column] = info['blocks'][column].values[start:start + len(chunk)]
+            chunk['city'] = info['city']
+            start += len(chunk)
+            chunk = chunk.reindex(columns=union)
+            chunk[vars_lcov] = chunk[vars_lcov].fillna(0)
+            chunk = prepare_data.adjust_columns(chunk, area_max, scale)
+            if scale:
+                chunk = scaler.transform(chunk)
+            for column, dtype, categories in schema:
+                arrays[column][row:row + len(chunk)] = columnar.encode(chunk[column].values, dtype, categories)
+            row += len(chunk)
+    for column in arrays:
+        arrays[column].flush()
+
+
+def read_chunks(fn_city, city, chunk_rows):
+    '''
+        The chunks of the city's grid, with the rows dropped by filter_city
+    '''
+    for chunk in pd.read_csv(fn_city, chunksize=chunk_rows):
+        yield(prepare_data.filter_city(chunk, city))
+
+
+def city_columns(fn_city, city, chunk_rows):
+    '''
+        Pass 1: the columns kept for the city (prepare_data.city_columns)
+    '''
+    n_rows = 0
+    n_null = None
+    for chunk in read_chunks(fn_city, city, chunk_rows):
+        n_rows += len(chunk)
+        chunk_null = chunk.isnull().sum()
+        n_null = chunk_null if n_null is None else n_null + chunk_null
+    return(prepare_data.city_columns(n_null.index, n_null / n_rows))
+
+
+def city_statistics(fn_city, city, columns, scale, chunk_rows):
+    '''
+        Pass 2: the moments of the numeric columns (and of the building area percent)
+        in the rows kept, the city means and the coordinates
+        Return
+            Dictionary of n_rows, moments, means, x, y
+    '''
+    moments = None
+    x, y = list(), list()
+    for chunk in read_chunks(fn_city, city, chunk_rows):
+        chunk = chunk[columns].dropna(axis='index', how='any')
+        values = chunk.select_dtypes(include=[np.number])
+        values = values.assign(**{BLDG_AREA: chunk.bldg / chunk.area * 100})
+        moments = merge_moments(moments, chunk_moments(values))
+        x.append(chunk.x.values)
+        y.append(chunk.y.values)
+    means = moments['mean'][prepare_data.centred_columns(columns, scale)]
+    return(dict(n_rows=int(moments.loc['x', 'count']), moments=moments, means=means,
+        x=np.concatenate(x), y=np.concatenate(y)))
+
+
+def feature_moments(info, vars_indep, area_max):
+    '''
+        The moments of the city's features after centre_city and adjust_columns,
+        from the moments of its raw columns. Removing the mean shifts the mean, min
+        and max, and scaling by k multiplies them by k (and m2 by k squared)
+    '''
+    moments = info['moments'].copy()
+    # the rows of the features
+    moments.loc['bldg'] = moments.loc[BLDG_AREA]
+    for column in vars_indep:
+        if column not in moments.index:
+            # land cover missing in the city is 0, other features are null
+            if 'lcov' in column:
+                moments.loc[column] = [info['n_rows'], 0, 0, 0, 0]
+            continue
+        if column in info['means'].index:
+            moments.loc[column, ['mean', 'min', 'max']] -= info['means'][column]
+        elif 'alb' in column:
+            moments.loc[column] = scale_moments(moments.loc[column], 100)
+        elif 'lcov' in column:
+            moments.loc[column] = scale_moments(moments.loc[column], 100 / area_max)
+    return(moments.reindex([i for i in vars_indep if i in moments.index]))
+
+
+def scale_moments(moments, k):
+    '''
+        The moments of the values multiplied by k (k > 0)
+    '''
+    moments = moments.copy()
+    moments[['mean', 'min', 'max']] *= k
+    moments['m2'] *= k**2
+    return(moments)
+
+
+def chunk_moments(df):
+    '''
+        The count, mean, sum of squared deviations, min and max of each column, ignoring nulls
+    '''
+    mean = df.mean()
+    return(pd.DataFrame({'count': df.count(), 'mean': mean, 'm2': ((df - mean)**2).sum(),
+        'min': df.min(), 'max': df.max()}, columns=MOMENTS))
+
+
+def merge_moments(a, b):
+    '''
+        Combine the moments of two sets of rows (Chan et al.'s parallel algorithm)
+    '''
+    if a is None:
+        return(b)
+    index = a.index.append(b.index.difference(a.index))
+    a, b = a.reindex(index), b.reindex(index)
+    n_a, n_b = a['count'].fillna(0), b['count'].fillna(0)
+    n = n_a + n_b
+    delta = (b['mean'] - a['mean']).fillna(0)
+    mean = a['mean'].where(n_b == 0, b['mean'].where(n_a == 0, a['mean'] + delta * n_b / n))
+    m2 = a['m2'].fillna(0) + b['m2'].fillna(0) + (delta**2 * n_a * n_b / n).fillna(0)
+    return(pd.DataFrame({'count': n, 'mean': mean, 'm2': m2,
+        'min': np.fmin(a['min'], b['min']), 'max': np.fmax(a['max'], b['max'])}, columns=MOMENTS))
+
+
+if __name__ == '__main__':
+    main()
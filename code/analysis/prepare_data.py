@@ -1,89 +1,184 @@
 '''
 Integrate the data sets, and scale the variables.
-Output is a csv with data for analysis
+Output is a columnar dataset (see columnar.py) with data for analysis, and
+the same data as a csv (data_regressions_{grid_size}_{date}.csv) for the notebooks
 '''
 
 # import libraries
 import pandas as pd
 import numpy as np
 import time
+import os
+import glob
+import json
+import hashlib
 import code
+import spatial_blocks
+import columnar
+import normalization
 scale = True
-def main(scale=True):
+# the spatial blocks for holdouts: column name and the arguments of
+# spatial_blocks.assign_blocks. Add e.g. 'holdout_hex_8': dict(method='hex', block_size=8)
+# or 'holdout_kmeans_8': dict(method='kmeans', block_size=8) to compare cross validation designs
+BLOCKINGS = {'holdout': dict(method='square', block_size=8)}
+VARS_RESPONSE = ['lst_day_mean','lst_night_mean','lst_night_max','lst_day_max']
+# the prepared city dataframes, by the hash of their input file and parameters
+PATH_CACHE = 'data/intermediate/prepare_data'
+# change to recompute the cache after changing scaling_city or holdout_grid
+PREPARE_VERSION = 2
+
+def main(scale=True, refresh=False):
 
     cities = ['bal','det','phx','por']
     grid_size = 500
     # init all city dataframe
-    df = pd.DataFrame()
-    add_index = 0
+    df_cities = list()
+    add_index = dict()
     for city in cities:
         # import city data
         # if grid_size == 100:
         #     dir_date = '2018-10-20'
         # else:
         dir_date = '2020-03-01'
-        df_city = pd.read_csv('data/processed/grid/{}/{}/{}_data_{}.csv'.format(city, dir_date, city,grid_size))
-        # scale city specific variables
-        df_city = scaling_city(df_city, scale)
-        # add the grid group numbers
-        df_city, add_index = holdout_grid(df_city, add_index)
+        fn_city = 'data/processed/grid/{}/{}/{}_data_{}.csv'.format(city, dir_date, city,grid_size)
+        # scale city specific variables and add the grid group numbers (cached)
+        df_city = prepare_city(fn_city, city, scale, refresh=refresh)
+        # make the grid group numbers unique between the cities
+        df_city, add_index = offset_holdouts(df_city, add_index)
         # append city name to df
         df_city['city'] = city
-        # bind to complete df
-        df = df.append(df_city, ignore_index=True)
+        df_cities.append(df_city)
+    # bind to complete df
+    df = pd.concat(df_cities, ignore_index=True)
     # apply transformation on entire dataset
     df = adjust_variables(df, scale)
     if scale:
         df = scaling_all(df, grid_size)
-    # write to csv
+    # write the columns
     df = df.loc[:, df.isnull().mean() < .00001]
     # code.interact(local = locals())
     if scale:
+        columnar.write_columns(df, 'data/data_regressions_{}'.format(grid_size))
+        # and the csv, for the notebooks
         df.to_csv('data/data_regressions_{}_{}.csv'.format(grid_size, time.strftime("%Y%m%d")))
     else:
+        columnar.write_columns(df, 'data/data_regressions_{}_unnormalized'.format(grid_size))
         df.to_csv('data/data_regressions_{}_{}_unnormalized.csv'.format(grid_size, time.strftime("%Y%m%d")))
 
 
-def scaling_city(df_city, scale):
+def prepare_city(fn_city, city, scale, blockings=BLOCKINGS, refresh=False):
+    '''
+    read the city's grid, scale it (scaling_city) and add the grid group numbers (holdout_grid)
+    city: the city's abbreviation (e.g. phx), for its filters
+    the result is cached in PATH_CACHE by the hash of the parameters and of the file, so it is
+    only recomputed when either changes (or refresh is True)
+    '''
+    key_parameters, key_file = cache_key(fn_city, city, scale, blockings)
+    name = os.path.splitext(os.path.basename(fn_city))[0]
+    fn_cache = os.path.join(PATH_CACHE, '{}_{}_{}.pkl'.format(name, key_parameters, key_file))
+    if os.path.exists(fn_cache) and not refresh:
+        return(pd.read_pickle(fn_cache))
+
+    df_city = pd.read_csv(fn_city)
+    df_city = scaling_city(df_city, city, scale)
+    df_city = holdout_grid(df_city, blockings)
+    # replace the out of date caches of the city with the same parameters (not e.g. those of the other scale)
+    os.makedirs(PATH_CACHE, exist_ok=True)
+    for fn_old in glob.glob(os.path.join(PATH_CACHE, '{}_{}_*.pkl'.format(name, key_parameters))):
+        os.remove(fn_old)
+    df_city.to_pickle(fn_cache)
+    return(df_city)
+
+
+def cache_key(fn_city, city, scale, blockings):
+    '''
+    hashes of the preparation parameters, and of the file's contents and the version of the preparation
+    '''
+    parameters = dict(city=city, scale=scale, blockings=blockings)
+    key_parameters = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:8]
+    sha = hashlib.sha1()
+    with open(fn_city, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(2**20), b''):
+            sha.update(chunk)
+    sha.update(json.dumps(dict(version=PREPARE_VERSION)).encode())
+    return(key_parameters, sha.hexdigest()[:16])
+
+
+def scaling_city(df_city, city, scale):
     '''
     scale the variables which are city specific (e.g. elevation has the city mean removed before [0,1] scaling)
     '''
+    df_city = filter_city(df_city, city)
 
-    vars_all = df_city.columns.values
+    # drop a couple of columns
+    df_city = df_city[city_columns(df_city.columns, df_city.isnull().mean())]
+#     # drop any nan rows and report how many dropped
+    df_city = df_city.dropna(axis='index', how='any')
+
+    # calculate the mean of each
+    city_means = df_city[centred_columns(df_city.columns, scale)].mean(axis=0)
+    df_city = centre_city(df_city, city_means, scale)
 
+    return(df_city)
+
+
+def filter_city(df_city, city):
+    '''
+    drop the rows outside the city and without the responses (scaling_city)
+    '''
     ### ADMIN ###
     df_city = df_city.drop(['Unnamed: 0', 'cId'], axis = 1)
     # outside city limits
-    df_city = df_city[df_city['area'] > 0]
+    keep = df_city['area'].values > 0
 
     # drop any values where the landsurface temperature is inf or nan
-    df_city = df_city[np.isfinite(df_city['lst_day_mean'])]
-    df_city = df_city[np.isfinite(df_city['lst_night_mean'])]
-    df_city = df_city[np.isfinite(df_city['lst_night_max'])]
-    df_city = df_city[np.isfinite(df_city['lst_day_max'])]
+    for var_response in VARS_RESPONSE:
+        keep &= np.isfinite(df_city[var_response].values)
 
     ## for phoenix - remove large rural areas outside of lidar zone
-    if df_city.city.iloc[100] == 'phx':
-        df_city = df_city[np.isfinite(df_city['svf_mean'])]
+    if city == 'phx':
+        keep &= np.isfinite(df_city['svf_mean'].values)
+
+    # setting NaN population regions to 0
+    keep &= np.isfinite(df_city['pdens_mean'].values)
+    # filter the rows once, rather than copying the frame for each condition
+    df_city = df_city[keep]
 
     # setting building NaN values to 0
-    df_city.bldg.fillna(0, inplace = True)
+    df_city = df_city.assign(bldg = df_city.bldg.fillna(0))
+    return(df_city)
 
-    # setting NaN population regions to 0
-    df_city = df_city[np.isfinite(df_city['pdens_mean'])]
 
+def city_columns(columns, null_fraction):
+    '''
+    the columns kept for a city, from the fraction of nulls of each column in the filtered rows
+    '''
     # drop a couple of columns
-    df_city = df_city.loc[:, df_city.isnull().mean() < .05]
+    vars_all = [i for i in columns if null_fraction[i] < .05]
     # drop_vars = ['bldg_sl', 'tree_max_sl', 'dsm_max_sl', 'dsm_mean_sl', 'dsm_min_sl', 'dsm_sd_sl']
-    # df_city = df_city.drop(drop_vars, axis=1)
 
     ### NaN variables
     # remove night time lights (not enough variance to get standard deviation)
+    vars_all = [x for x in vars_all if 'ntl' not in x]
+    return(vars_all)
+
+
+def centred_columns(columns, scale):
+    '''
+    the columns which have the city mean removed
+    '''
+    # elevation and dsm (except standard deviation)
+    vars_centre = [i for i in columns if ('elev' in i or 'dsm' in i) and 'sd' not in i]
+    if scale:
+        vars_centre += [i for i in VARS_RESPONSE if i in columns]
+    return(vars_centre)
+
+
+def centre_city(df_city, city_means, scale):
+    '''
+    remove the city means (from centred_columns) and drop the other lst variables
+    '''
     vars_all = df_city.columns.values
-    vars_ntl = [x for x in vars_all if 'ntl' in x]
-    df_city = df_city.drop(vars_ntl, axis=1)
-#     # drop any nan rows and report how many dropped
-    df_city = df_city.dropna(axis='index', how='any')
 
     ### Elevation ###
     # subtract the mean from all of the elevation variables (except standard deviation)
@@ -91,9 +186,7 @@ def scaling_city(df_city, scale):
     vars_elev = [i for i in vars_all if 'elev' in i]
     # remove sd vars
     vars_elev = [x for x in vars_elev if 'sd' not in x]
-    # calculate the mean of each
-    elev_means = df_city[vars_elev].mean(axis=0)
-    df_city[vars_elev] = df_city[vars_elev] - elev_means
+    df_city[vars_elev] = df_city[vars_elev] - city_means[vars_elev]
 
     ### Albedo ###
     # multiply by 100 to get percent
@@ -102,30 +195,23 @@ def scaling_city(df_city, scale):
     # scale
     df_city[vars_alb] = df_city[vars_alb]*100
 
-
-
     ### DSM ###
     # subtract the mean from all of the dsm variables (except standard deviation)
     # list dsm vars
     vars_dsm = [i for i in vars_all if 'dsm' in i]
     # remove sd vars
     vars_dsm = [x for x in vars_dsm if 'sd' not in x]
-    # calculate the mean of each
-    dsm_means = df_city[vars_dsm].mean(axis=0)
-    df_city[vars_dsm] = df_city[vars_dsm] - dsm_means
+    df_city[vars_dsm] = df_city[vars_dsm] - city_means[vars_dsm]
 
     ### LST ###
     # drop the lst vars except night and day mean
-    vars_response = ['lst_day_mean','lst_night_mean','lst_night_max','lst_day_max']
     vars_lst = [i for i in vars_all if 'lst' in i]
     # remove vars to keep
-    vars_lst_drop = [x for x in vars_lst if x not in vars_response]
+    vars_lst_drop = [x for x in vars_lst if x not in VARS_RESPONSE]
     # drop vars
     df_city = df_city.drop(vars_lst_drop, axis=1)
-    # calculate the mean of each
     if scale:
-        lst_means = df_city[vars_response].mean(axis=0)
-        df_city[vars_response] = df_city[vars_response] - lst_means
+        df_city[VARS_RESPONSE] = df_city[VARS_RESPONSE] - city_means[VARS_RESPONSE]
 
     return(df_city)
 
@@ -140,6 +226,16 @@ def adjust_variables(df, scale):
     area_max = np.max([np.max(df[i]) for i in vars_lcov])
     # divide these values by the area value
     df = df[df['area'] > 0]
+    return(adjust_columns(df, area_max, scale))
+
+
+def adjust_columns(df, area_max, scale):
+    '''
+    rescale the land cover and building area, and drop the unused columns (adjust_variables)
+    area_max: the max land cover area of a cell
+    '''
+    vars_all = df.columns.values
+    vars_lcov = [i for i in vars_all if 'lcov' in i]
     for var_lcov in vars_lcov:
         df[var_lcov] = df[var_lcov]/area_max*100
     # drop rows with water more than 20% of area
@@ -170,46 +266,33 @@ def scaling_all(df, grid_size):
     scale the variables between the cities
     '''
     # code.interact(local = locals())
-    # Transform to [0,1]
-    normalize_parameters = pd.DataFrame()
+    # standardize the independent variables
     vars_all = df.columns.values
-    vars_indep = [i for i in vars_all if 'lst' not in i and i not in ['x','y','holdout','city']]
-    for indep_var in vars_indep:
-        # calc max and min
-        var_min = np.min(df[indep_var])
-        var_max = np.max(df[indep_var])
-        var_mean = np.mean(df[indep_var])
-        var_sd = np.std(df[indep_var])
-        normalize_parameters = normalize_parameters.append({'feature': indep_var,'mean': var_mean,'sd': var_sd,'max': var_max, 'min': var_min}, ignore_index=True)
-        # transform to [0,1]
-        # df[indep_var] = (df[indep_var] - var_min) / (var_max - var_min)
-        df[indep_var] = (df[indep_var] - var_mean) / (var_sd)
-    normalize_parameters.to_csv('data/normalization_parameters_{}.csv'.format(grid_size))
+    vars_indep = [i for i in vars_all if 'lst' not in i and i not in ['x','y','city'] and not i.startswith('holdout')]
+    scaler = normalization.FeatureScaler().fit(df, vars_indep)
+    scaler.save(grid_size)
+    df = scaler.transform(df)
     return(df)
 
 
-def holdout_grid(df_city, add_index):
+def holdout_grid(df_city, blockings=BLOCKINGS):
     '''
-    assign each row a spatial cell group number.
+    assign each row a spatial cell group number for each of the blockings.
     holdouts will be done at the cell group to avoid overfitting
     '''
-    # how many cells
-    cell_size = 8
-    coords = np.unique(df_city.x), np.unique(df_city.y)
-    n_cells = round(len(coords[0]) / cell_size), round(len(coords[1]) / cell_size)
-    # what are the coord cutoffs
-    cutoffs_x = [coords[0][cell_size*i-1] for i in range(1,n_cells[0])] + [np.max(coords[0])]
-    cutoffs_y = [coords[1][cell_size*i-1] for i in range(1,n_cells[1])] + [np.max(coords[1])]
-    # assign a number to each of the rows as to which cell group it is in
-    df_city['holdout'] = None
-    for index, r in df_city.iterrows():
-        r_ix = np.searchsorted(cutoffs_x,r.x)
-        r_iy = np.searchsorted(cutoffs_y,r.y)
-        df_city.loc[index, 'holdout'] = r_iy * n_cells[0] + r_ix
-
-    # I want the holdout values to be unique (intercity)
-    df_city.holdout += add_index
-    add_index = np.max(df_city.holdout)
+    for column, blocking in blockings.items():
+        df_city[column] = spatial_blocks.assign_blocks(df_city.x.values, df_city.y.values, **blocking)
+    return(df_city)
+
+
+def offset_holdouts(df_city, add_index, blockings=BLOCKINGS):
+    '''
+    I want the holdout values to be unique (intercity)
+    add_index: the largest group number so far of each blocking column
+    '''
+    for column in blockings:
+        df_city[column] += add_index.get(column, 0)
+        add_index[column] = np.max(df_city[column])
     return(df_city, add_index)
 
 if __name__ == '__main__':
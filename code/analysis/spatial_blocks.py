@@ -0,0 +1,152 @@
+'''
+Assign the grid cells of a city to spatial blocks for holdouts
+
+Each function takes the arrays of cell coordinates and returns a block number
+for every cell at once
+        square: blocks of block_size x block_size cells (the holdout blocks of
+                prepare_data.holdout_grid)
+        hex: hexagons block_size cells across
+        kmeans: k-means clusters of the coordinates, with on average
+                block_size x block_size cells in each
+SpatialHoldout splits the cells into training and test sets by their blocks
+'''
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+
+def assign_blocks(x, y, method='square', block_size=8, random_state=0):
+    '''
+        Block number of each cell by the method (square, hex, kmeans)
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if method == 'square':
+        return(square_blocks(x, y, block_size))
+    elif method == 'hex':
+        return(hex_blocks(x, y, block_size))
+    elif method == 'kmeans':
+        return(kmeans_blocks(x, y, block_size, random_state))
+    raise ValueError('Unknown blocking method: {}'.format(method))
+
+
+def square_blocks(x, y, block_size=8):
+    '''
+        Blocks of block_size unique x by block_size unique y coordinates, numbered
+        by row then column (the last block in each direction takes any remainder)
+    '''
+    coords = np.unique(x), np.unique(y)
+    n_blocks = [max(int(round(len(c) / block_size)), 1) for c in coords]
+    # the coordinate cutoffs of the blocks
+    cutoffs = [np.append(c[block_size * np.arange(1, n) - 1], c.max()) for c, n in zip(coords, n_blocks)]
+    ix = np.searchsorted(cutoffs[0], x)
+    iy = np.searchsorted(cutoffs[1], y)
+    return(iy * n_blocks[0] + ix)
+
+
+def hex_blocks(x, y, block_size=8):
+    '''
+        Pointy topped hexagons, block_size cells across (flat side to flat side),
+        numbered from 0 in order of their position
+    '''
+    spacing = cell_spacing(x)
+    # the circumradius of the hexagon
+    size = block_size * spacing / np.sqrt(3)
+    px, py = x - x.min(), y - y.min()
+
+    # fractional axial coordinates, rounded to the nearest hexagon in cube coordinates
+    q = (np.sqrt(3) / 3 * px - py / 3) / size
+    r = (2 / 3 * py) / size
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq[fix_q] = -rr[fix_q] - rs[fix_q]
+    rr[fix_r] = -rq[fix_r] - rs[fix_r]
+
+    hexagons = np.stack([rr, rq], axis=1).astype(np.int64)
+    return(np.unique(hexagons, axis=0, return_inverse=True)[1].ravel())
+
+
+def kmeans_blocks(x, y, block_size=8, random_state=0):
+    '''
+        K-means clusters of the coordinates, with one cluster per block_size**2 cells
+    '''
+    n_blocks = max(int(round(len(x) / block_size**2)), 1)
+    coords = np.stack([x, y], axis=1)
+    kmeans = KMeans(n_clusters=n_blocks, n_init=3, random_state=random_state).fit(coords)
+    return(kmeans.labels_)
+
+
+def cell_spacing(x):
+    '''
+        The grid size, as the smallest spacing of the x coordinates
+    '''
+    # rounded, as the coordinates are saved in a csv
+    return(np.diff(np.unique(np.round(x, 3))).min())
+
+
+class SpatialHoldout(object):
+    '''
+        Hold out randomly drawn blocks until they hold test_size of the rows
+        (as analysis.split_holdout did), for the scikit-learn cross validation API,
+        e.g. cross_val_score(model, X, y, groups=df.holdout, cv=SpatialHoldout(0.2, 10))
+        The block sizes are counted once for a groups array and reused across
+        splits (and seeded holdouts, see holdout), and each split draws the blocks
+        with a single permutation
+    '''
+
+    def __init__(self, test_size=0.2, n_splits=1, random_state=None):
+        self.test_size = test_size
+        self.n_splits = n_splits
+        self.random_state = random_state
+        self._groups = None
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return(self.n_splits)
+
+    def split(self, X=None, y=None, groups=None):
+        '''
+            Yield the integer indices of the training and test rows of each split
+        '''
+        if groups is None:
+            raise ValueError('The groups (block of each row) are required')
+        rng = np.random.RandomState(self.random_state) if self.random_state is not None else np.random
+        for i in range(self.n_splits):
+            yield(self.draw(groups, rng))
+
+    def holdout(self, groups, random_state=None):
+        '''
+            The integer indices of the training and test rows of a single split,
+            seeded by random_state (default: numpy's global random state), so one
+            splitter serves many seeded holdouts of the same groups
+        '''
+        rng = np.random.RandomState(random_state) if random_state is not None else np.random
+        return(self.draw(groups, rng))
+
+    def draw(self, groups, rng):
+        '''
+            Draw the test blocks of a split with the random state rng
+        '''
+        codes, sizes = self.block_sizes(groups)
+        # hold out 95% of the test size, as split_holdout did
+        required = len(codes) * self.test_size * 0.95
+        order = rng.permutation(len(sizes))
+        # the fewest blocks (in the drawn order) holding the required rows
+        n_test = np.searchsorted(np.cumsum(sizes[order]), required) + 1 if required > 0 else 0
+        test_blocks = np.zeros(len(sizes), dtype=bool)
+        test_blocks[order[:n_test]] = True
+        test = test_blocks[codes]
+        return(np.flatnonzero(~test), np.flatnonzero(test))
+
+    def block_sizes(self, groups):
+        '''
+            The block code of each row and the number of rows of each block
+            (cached for the last groups array)
+        '''
+        if self._groups is not groups:
+            codes = np.unique(np.asarray(groups), return_inverse=True)[1]
+            self._groups = groups
+            self._codes, self._sizes = codes, np.bincount(codes)
+        return(self._codes, self._sizes)
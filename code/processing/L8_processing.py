@@ -30,80 +30,551 @@ import pandas as pd
 from osgeo import gdal
 from osgeo import gdal_array
 from osgeo import osr
+from osgeo import ogr
 import shapefile
 from matplotlib import pyplot as plt
 import code
 # from rpy2.robjects.packages import importr
-import subprocess
 import os
-os.chdir('F:/UrbanDataProject/land_surface_temperature')
+import warnings
+import hashlib
+import time
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import threading
+import queue
+from contextlib import contextmanager
+if __name__ == '__main__':
+    # only when run as a script, so the module can be imported (e.g. by benchmark.py)
+    os.chdir('F:/UrbanDataProject/land_surface_temperature')
 
 # init logging
 import sys
 sys.path.append("code")
 from logger_config import *
 logger = logging.getLogger(__name__)
-
-def main():
+import scene_catalog
+from instrumentation import stage, pop_records, merge_records, write_records, summarize_records
+
+# the products calculated from each image and the bands each is calculated from
+PRODUCTS = ['thermal-radiance', 'lst', 'ndvi', 'nbdi', 'albedo']
+PRODUCT_BANDS = {'thermal-radiance': [10], 'lst': [10], 'ndvi': [4,5], 'nbdi': [5,6], 'albedo': [1,3,4,5,7]}
+# the statistics saved when compositing the images of a city
+MEAN_STATISTICS = ['mean', 'std', 'count']
+# emissivity of the land cover classes: (first class code, last class code + 1, emissivity)
+# land cover codes are here: https://www.mrlc.gov/nlcd11_leg.php
+EMISSIVITY_CLASSES = [(1, 20, 0.989), # Water
+                    (20, 30, 0.912), # Developed
+                    (30, 40, 0.896), # Barren
+                    (40, 50, 0.967), # Forest
+                    (50, 80, 0.957), # Grass
+                    (80, 90, 0.957), # Cropland
+                    (90, 256, 0.957)] # Wetlands is assumed to be Sparse Vegetation
+# layout and compression of the processed images (see create_raster)
+# ZSTD needs GDAL >= 2.3, the predictor 3 is for floating point data
+RASTER_TILED = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256']
+RASTER_PROFILES = {
+    'plain': {'options': [], 'overviews': False, 'cog': False},
+    'deflate': {'options': RASTER_TILED + ['COMPRESS=DEFLATE', 'PREDICTOR=3'], 'overviews': True, 'cog': False},
+    'zstd': {'options': RASTER_TILED + ['COMPRESS=ZSTD', 'PREDICTOR=3'], 'overviews': True, 'cog': False},
+    'lzw': {'options': RASTER_TILED + ['COMPRESS=LZW', 'PREDICTOR=3'], 'overviews': True, 'cog': False},
+    'cog': {'options': RASTER_TILED + ['COMPRESS=DEFLATE', 'PREDICTOR=3'], 'overviews': True, 'cog': True},
+    }
+RASTER_PROFILE = 'plain'
+COG_WORKING_SUFFIX = '.working.tif'
+# the satellite bands clipped to the city (band 10 first, it defines the grid for the others)
+CLIP_BANDS = [10,1,2,3,4,5,6,7]
+# projection (meters) the city boundary is buffered in
+BUFFER_EPSG = 26978
+# the last emissivity map read whole by this process, keyed by filename, modified time
+# and dtype (only the last, as the scenes are on different grids and rarely share one)
+EMISSIVITY_CACHE = dict()
+# the land cover and emissivity on each scene grid, named by the key of their inputs
+PATH_GRID_CACHE = 'data/intermediate/{}/grid'
+# seconds after which a lock file is taken to be left by a process which died
+LOCK_TIMEOUT = 3600
+
+# the floating point type the products are calculated in
+# float32 halves the memory of each array, and the products are saved as Float32 regardless
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+PRECISION = 'float64'
+
+# rows of the scene the fused thermal kernel calculates at a time (see thermal_products)
+THERMAL_BLOCK_ROWS = 128
+
+# windows held in each of the background read and write queues (0 reads and writes in line)
+IO_QUEUE_DEPTH = 2
+# the tile (pixels along a side) the means are composited in when no tile_size is given
+MEAN_TILE_SIZE = 1024
+
+def main(tile_size=None, products=PRODUCTS, n_workers=1, profile=RASTER_PROFILE, precision=PRECISION,
+        n_threads=1, scene_filter=None):
     '''
         loops through satellite images and processes them
+        tile_size: process the images window by window (see calc_products)
+        products: the maps to create for each image
+        n_workers: number of processes the images are processed across
+        profile: layout and compression of the saved images (see RASTER_PROFILES)
+        precision: floating point type of the calculations (see PRECISIONS)
+        n_threads: threads each process calculates the thermal products across
+        scene_filter: optional dictionary of arguments to scene_catalog.query_scenes
+            (e.g. city, day_night, max_cloud_cover) selecting the images to process
+        The time, bytes read and written, and memory of each stage are appended to
+        instrumentation.STAGE_LOG and summarized at the end
     '''
+    run = time.strftime('%Y%m%d_%H%M%S')
     # Read the source csv with the satellite id numbers of the
     source_city = pd.read_csv('data/data_source_city.csv')
     source_satellite = pd.read_csv('data/data_source_satellite.csv')
-    info_satellite = source_satellite.iloc[0]
-    # loop rows
-    for index, info_satellite in source_satellite.iterrows():
-        # process the image
-        logger.info('Processing image {}: {}'.format(info_satellite['city'], info_satellite['landsat_product_id']))
-        process_image(info_satellite, source_city)
-
-    # take average of images
-    for city in np.unique(source_satellite['city']):
-        # loop cities
-        for day_night in ['day', 'night']:
-            # loop day and night
-            # filter the source_satellite df for the images which I'll then mean
-            images_meta = source_satellite.loc[(source_satellite['city'] == city) & (source_satellite['day_night'] == day_night) & source_satellite['include']]
-            # average images
-            image_mean(images_meta, day_night, city)
-
-
-
-def process_image(info_satellite, source_city):
+    # catalog the metadata of any new scenes
+    with stage('catalog'):
+        source_satellite = scene_catalog.update_catalog(source_satellite)
+    if scene_filter is not None:
+        source_satellite = scene_catalog.query_scenes(**scene_filter)
+    records = pop_records()
+    write_records(records, run=run)
+    # process the images and take the average of them
+    records += schedule_images(source_satellite, source_city, n_workers, tile_size, products, profile,
+        precision, n_threads, run)
+
+    logger.info('Stages of run {} (seconds, MB):\n{}'.format(run, summarize_records(records).to_string()))
+
+
+def schedule_images(source_satellite, source_city, n_workers, tile_size=None, products=PRODUCTS,
+        profile=RASTER_PROFILE, precision=PRECISION, n_threads=1, run=None):
+    '''
+        Process the satellite images across a pool of n_workers processes
+        The mean for a city and day/night is calculated as soon as all of the
+        images it includes have been processed, rather than after every image
+        Return
+            List of the stage records of the workers (see instrumentation), which
+            are written to the log as each image and mean finishes
+    '''
+    records = list()
+    # the images (row index) each of the city and day/night means is waiting on
+    means_waiting = dict()
+    images_include = source_satellite.loc[source_satellite['include']]
+    for (city, day_night), images_meta in images_include.groupby(['city', 'day_night']):
+        means_waiting[(city, day_night)] = set(images_meta.index)
+
+    # clip the layers of each city once, before the processes put them on their scene grids
+    for city in source_satellite['city'].unique():
+        with stage('clip_city', city=city):
+            clip_city_layers(city, source_city)
+    records += pop_records()
+    write_records(records, run=run)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        # submit the images
+        futures_image = dict()
+        for index, info_satellite in source_satellite.iterrows():
+            logger.info('Submitting image {}: {}'.format(info_satellite['city'], info_satellite['landsat_product_id']))
+            future = pool.submit(process_image, info_satellite, source_city, tile_size, products, profile,
+                precision, n_threads)
+            futures_image[future] = index
+
+        # as images finish, submit the means which are no longer waiting
+        futures_mean = list()
+        for future in as_completed(futures_image):
+            index = futures_image[future]
+            # raise any error from processing the image
+            image_records = future.result()
+            write_records(image_records, run=run)
+            records += image_records
+            info_satellite = source_satellite.loc[index]
+            logger.info('Processed image {}: {}'.format(info_satellite['city'], info_satellite['landsat_product_id']))
+            key = (info_satellite['city'], info_satellite['day_night'])
+            if key in means_waiting and index in means_waiting[key]:
+                means_waiting[key].remove(index)
+                if not means_waiting[key]:
+                    # filter the source_satellite df for the images which I'll then mean
+                    images_meta = images_include.loc[(images_include['city'] == key[0]) & (images_include['day_night'] == key[1])]
+                    futures_mean.append(pool.submit(image_mean, images_meta, key[1], key[0], products, tile_size, profile=profile))
+                    del means_waiting[key]
+
+        # wait for the means, raising any errors
+        for future in as_completed(futures_mean):
+            mean_records = future.result()
+            write_records(mean_records, run=run)
+            records += mean_records
+
+    return(records)
+
+
+def process_image(info_satellite, source_city, tile_size=None, products=PRODUCTS, profile=RASTER_PROFILE,
+        precision=PRECISION, n_threads=1):
     '''
         1. Reads in metadata
         2. Creates map of land surface temperature
         3. Creates map of NDVI
         4. Creates map of NBDI
         5. Creates map of albedo
+        The maps are calculated together by calc_products, which reads each band once
+        If tile_size is given the maps are calculated window by window, so memory is
+        bounded by the tile not the scene
+        Return
+            List of the records of each stage (see instrumentation)
     '''
+    scene = scene_context(info_satellite)
     # read metadata
-    meta_dict = read_metadata(info_satellite)
+    with stage('metadata', **scene):
+        meta_dict = read_metadata(info_satellite)
 
     # clip the images to the city and ensure they are same projection
-    clip_geographic_data(info_satellite, source_city)
+    with stage('clip', **scene):
+        clip_geographic_data(info_satellite, source_city)
 
-    # create map of land surface temperature
-    calc_LST(info_satellite, meta_dict, source_city)
+    # create the maps of land surface temperature, ndvi, nbdi, and albedo
+    # the calculation of each product is recorded as a stage of its own
+    with stage('products', **scene):
+        calc_products(info_satellite, meta_dict, source_city, products, tile_size, profile, precision, n_threads)
 
-    # create ndvi and nbdi map
-    calc_NDVI(info_satellite)
-    calc_NBDI(info_satellite)
+    # the products are calculated window by window - combine their windows
+    return(merge_records(pop_records()))
 
-    # create map of albedo
-    calc_albedo(info_satellite, meta_dict)
+
+def scene_context(info_satellite):
+    '''
+        The fields identifying the scene in the stage records
+    '''
+    return(dict(city=info_satellite['city'], landsat_product_id=info_satellite['landsat_product_id'],
+        date=str(info_satellite['date']), day_night=info_satellite['day_night']))
+
+
+def required_bands(products):
+    '''
+        The satellite bands needed to calculate the products
+    '''
+    bands = set()
+    for product in products:
+        bands.update(PRODUCT_BANDS[product])
+    return(sorted(bands))
+
+
+def calc_products(info_satellite, meta_dict, source_city, products=PRODUCTS, tile_size=None,
+        profile=RASTER_PROFILE, precision=PRECISION, n_threads=1, io_depth=IO_QUEUE_DEPTH):
+    '''
+        Calculate the requested products (thermal radiance, LST, NDVI, NBDI, albedo)
+        in a single pass: each band the products need is read exactly once and
+        shared between them
+        tile_size is None to read the whole scene, 'block' to follow the GeoTIFF's
+        native blocks, or the number of pixels along the side of a square tile
+        profile: layout and compression of the saved images (see RASTER_PROFILES)
+        precision: floating point type of the calculations (see PRECISIONS)
+        n_threads: threads the thermal products are calculated across
+        io_depth: windows read ahead and waiting to be written (see prefetch and write_behind)
+    '''
+    bands = required_bands(products)
+    logger.info('Calculating {} from bands {}'.format(', '.join(products), bands))
+
+    # open the clipped bands - these are only read a window at a time
+    ds_band = dict()
+    for band in bands:
+        ds_band[band] = gdal.Open(band_filename(info_satellite, band))
+    if 'lst' in products:
+        # the emissivity is cached per scene grid - in memory when reading the whole scene
+        fn_emissivity = cache_emissivity(info_satellite, source_city)
+        if tile_size is None:
+            emissivity_scene = load_emissivity(fn_emissivity, PRECISIONS[precision])
+        else:
+            ds_emissivity = gdal.Open(fn_emissivity)
+    # the outputs are on the grid of the highest band read (band 10 when there is lst)
+    ds_grid = ds_band[bands[-1]]
+
+    # create the output rasters
+    ds_out = dict()
+    for product in products:
+        ds_out[product] = create_raster(product_filename(info_satellite, product), ds_grid, profile=profile)
+
+    def read_window(window):
+        # read the window from each band
+        xoff, yoff, xsize, ysize = window
+        dn = dict()
+        for band, ds in ds_band.items():
+            dn[band] = ds.ReadAsArray(xoff, yoff, xsize, ysize)
+        emissivity = None
+        if 'lst' in products:
+            if tile_size is None:
+                emissivity = emissivity_scene
+            else:
+                emissivity = ds_emissivity.ReadAsArray(xoff, yoff, xsize, ysize).astype(
+                    PRECISIONS[precision], copy=False)
+        return(window, dn, emissivity)
+
+    def write_window(window, results):
+        xoff, yoff, xsize, ysize = window
+        for product in products:
+            ds_out[product].GetRasterBand(1).WriteArray(results[product], xoff, yoff)
+
+    # loop through the windows - the next windows are read, and the finished ones
+    # written, in the background while the products are calculated
+    # (on an error, the threads are stopped before it is raised)
+    write, finish_writing = write_behind(write_window, io_depth)
+    windows = prefetch(map(read_window, iter_windows(ds_grid, tile_size)), io_depth)
+    try:
+        for window, dn, emissivity in windows:
+            # calculate and write the products
+            results = calc_products_window(dn, emissivity, meta_dict, info_satellite, products, precision,
+                n_threads)
+            write(window, results)
+        finish_writing()
+    finally:
+        windows.close()
+        finish_writing(discard=True)
+
+    # write to disk (dropping each dataset before its cog working file is removed)
+    for product in products:
+        dataset = ds_out.pop(product)
+        fn_working = close_raster(dataset, profile)
+        dataset = None
+        remove_working(fn_working)
+
+
+def calc_products_window(dn, emissivity, meta_dict, info_satellite, products, precision=PRECISION,
+        n_threads=1):
+    '''
+        Calculate the products from the band arrays (whole scene or a window of it)
+        The bands are converted to the precision's floating point type once, and
+        the calculations keep that type (working in place where they can)
+        n_threads: threads the thermal products are calculated across
+        Return
+            Dictionary of product arrays
+    '''
+    dtype = PRECISIONS[precision]
+    scene = scene_context(info_satellite)
+    results = dict()
+
+    # thermal radiance and land surface temperature share the TOA radiance,
+    # and are calculated block by block from the raw band 10 (see thermal_products)
+    thermal = [product for product in products if product in ['thermal-radiance', 'lst']]
+    if thermal:
+        with stage('lst', **scene):
+            results.update(thermal_products(dn[10], emissivity, meta_dict, info_satellite, thermal,
+                dtype, n_threads))
+
+    # the other bands are read as integers - convert each once
+    dn = {band: values.astype(dtype, copy=False) for band, values in dn.items() if band != 10}
+
+    # vegetation and built-up indices
+    if 'ndvi' in products:
+        with stage('ndvi', **scene):
+            results['ndvi'] = ndvi_from_bands(dn[4], dn[5])
+    if 'nbdi' in products:
+        with stage('nbdi', **scene):
+            results['nbdi'] = nbdi_from_bands(dn[5], dn[6])
+
+    # albedo
+    if 'albedo' in products:
+        with stage('albedo', **scene):
+            reflect_band = dict()
+            for band in PRODUCT_BANDS['albedo']:
+                reflect_band[band] = calc_TOA_reflectance(dn[band], meta_dict, band)
+            results['albedo'] = albedo_from_reflectance(reflect_band)
+
+    return(results)
+
+
+def validate_precision(info_satellite, meta_dict, source_city, products=PRODUCTS, precision='float32',
+        tile_size=None):
+    '''
+        Compare the products calculated in the given precision with float64, window by
+        window (see calc_products), without saving them
+        Return
+            Dataframe of the maximum absolute and relative deviation of each product
+            and the number of pixels which are NaN in only one of the two
+    '''
+    bands = required_bands(products)
+    ds_band = dict()
+    for band in bands:
+        ds_band[band] = gdal.Open(band_filename(info_satellite, band))
+    if 'lst' in products:
+        ds_emissivity = gdal.Open(cache_emissivity(info_satellite, source_city))
+    ds_grid = ds_band[bands[-1]]
+
+    deviation = pd.DataFrame(0.0, index=products, columns=['max_abs', 'max_rel', 'nan_mismatch'])
+    for xoff, yoff, xsize, ysize in iter_windows(ds_grid, tile_size):
+        dn = dict()
+        for band, ds in ds_band.items():
+            dn[band] = ds.ReadAsArray(xoff, yoff, xsize, ysize)
+        emissivity = None
+        if 'lst' in products:
+            emissivity = ds_emissivity.ReadAsArray(xoff, yoff, xsize, ysize)
+        window = compare_precision(dn, emissivity, meta_dict, info_satellite, products, precision)
+        deviation[['max_abs', 'max_rel']] = np.fmax(deviation[['max_abs', 'max_rel']], window[['max_abs', 'max_rel']])
+        deviation['nan_mismatch'] += window['nan_mismatch']
+
+    logger.info('Deviation of {} from float64:\n{}'.format(precision, deviation))
+    return(deviation)
+
+
+def compare_precision(dn, emissivity, meta_dict, info_satellite, products, precision='float32'):
+    '''
+        Calculate the products from the band arrays in the given precision and in
+        float64 (see calc_products_window) and measure the deviation
+        Return
+            Dataframe of the maximum absolute and relative deviation of each product
+            and the number of pixels which are NaN in only one of the two
+    '''
+    reference = calc_products_window(dn, emissivity, meta_dict, info_satellite, products, 'float64')
+    results = calc_products_window(dn, emissivity, meta_dict, info_satellite, products, precision)
+
+    deviation = pd.DataFrame(0.0, index=products, columns=['max_abs', 'max_rel', 'nan_mismatch'])
+    for product in products:
+        expected = reference[product]
+        actual = results[product].astype(np.float64)
+        valid = np.isfinite(expected) & np.isfinite(actual)
+        deviation.loc[product, 'nan_mismatch'] = np.sum(np.isfinite(expected) != np.isfinite(actual))
+        if valid.any():
+            diff = np.abs(actual[valid] - expected[valid])
+            deviation.loc[product, 'max_abs'] = diff.max()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel = diff / np.abs(expected[valid])
+            # ignore pixels where the float64 product is zero
+            rel = rel[np.isfinite(rel)]
+            if rel.size:
+                deviation.loc[product, 'max_rel'] = rel.max()
+    return(deviation)
+
+
+def iter_windows(ds, tile_size):
+    '''
+        Yield the (xoff, yoff, xsize, ysize) windows which cover the raster
+        tile_size is None for a single window of the whole raster, 'block' to use
+        the raster's native block size, otherwise the number of pixels along the
+        side of a square tile
+    '''
+    if tile_size is None:
+        x_block, y_block = ds.RasterXSize, ds.RasterYSize
+    elif tile_size == 'block':
+        x_block, y_block = ds.GetRasterBand(1).GetBlockSize()
+    else:
+        x_block, y_block = int(tile_size), int(tile_size)
+    # loop rows of windows then columns
+    for yoff in range(0, ds.RasterYSize, y_block):
+        ysize = min(y_block, ds.RasterYSize - yoff)
+        for xoff in range(0, ds.RasterXSize, x_block):
+            xsize = min(x_block, ds.RasterXSize - xoff)
+            yield xoff, yoff, xsize, ysize
+
+
+def prefetch(items, depth=IO_QUEUE_DEPTH):
+    '''
+        Iterate over items (e.g. windows being read) in a background thread, keeping
+        up to depth of them ready, so reading overlaps with the calculations
+        Any error raised by the items is raised here. Closing the iterator (or
+        leaving a loop over it by an error) stops the thread and waits for it
+    '''
+    if depth == 0:
+        for item in items:
+            yield item
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+    def offer(entry):
+        # queue the entry, unless the consumer has stopped
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return(True)
+            except queue.Full:
+                continue
+        return(False)
+    def produce():
+        try:
+            for item in items:
+                if not offer((item, None)):
+                    return
+        except Exception as error:
+            offer((done, error))
+            return
+        offer((done, None))
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def write_behind(write, depth=IO_QUEUE_DEPTH):
+    '''
+        Call write in a background thread, with up to depth calls waiting, so writing
+        overlaps with the calculations
+        Return
+            submit: queues a call of write with its arguments (blocking while the queue is full)
+            finish: waits for the queued writes, raising any error from them. With
+                discard=True (e.g. after an error in the calculations) the queued
+                writes are dropped and no error is raised. Only the first call has
+                any effect, so finish(discard=True) can always be called in a finally
+    '''
+    if depth == 0:
+        return(write, lambda discard=False: None)
+
+    buffer = queue.Queue(maxsize=depth)
+    errors = list()
+    discarding = threading.Event()
+    def consume():
+        while True:
+            args = buffer.get()
+            if args is None:
+                break
+            # after an error, or when discarding, only empty the queue
+            if not errors and not discarding.is_set():
+                try:
+                    write(*args)
+                except Exception as error:
+                    errors.append(error)
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+
+    def submit(*args):
+        if errors:
+            raise errors[0]
+        buffer.put(args)
+    def finish(discard=False):
+        if not thread.is_alive():
+            return
+        if discard:
+            discarding.set()
+        buffer.put(None)
+        thread.join()
+        if errors and not discard:
+            raise errors[0]
+    return(submit, finish)
+
+
+def band_filename(info_satellite, band):
+    '''
+        Filename of the satellite band clipped to the city
+    '''
+    return('data/intermediate/{}/{}_B{}.tif'.format(info_satellite['city'], info_satellite['landsat_product_id'], band))
+
+
+def product_filename(info_satellite, product):
+    '''
+        Filename of a processed image, e.g. the lst for the satellite image's date
+    '''
+    return('data/processed/image/{}/{}_{}_{}.tif'.format(info_satellite['city'], product, info_satellite['date'], info_satellite['day_night']))
 
 
 def read_metadata(info_satellite):
     '''
-        For the image read the metadata txt file
+        For the image read the metadata from the scene catalog (the MTL txt file is
+        parsed into the catalog the first time - see scene_catalog)
         Return
             Dictionary of metadata
     '''
     logger.info('Reading metadata')
-    # metadata file and location
-    fn_metadata = 'data/raw/{}/{}_MTL.txt'.format(info_satellite['city'],info_satellite['landsat_product_id'])
     #
     # list of variables needed from metadata
     meta_variables = set(['K1_CONSTANT_BAND_10','K2_CONSTANT_BAND_10','SUN_ELEVATION'])
@@ -114,99 +585,305 @@ def read_metadata(info_satellite):
             meta_variables.add('RADIANCE_{}_BAND_{}'.format(rad, b))
             meta_variables.add('REFLECTANCE_{}_BAND_{}'.format(rad, b))
     #
-    # init dictionary
+    # init dictionary, so any variable missing from the metadata is None
     meta_dict = dict.fromkeys(meta_variables)
-    # open the metadata file
-    with open(fn_metadata,'r') as fid:
-        # loop lines in text file
-        for line in fid:
-            # divide line into words, split by space
-            elements = line.split()
-            # intersect with metavariables to return set of variable name if it is on line
-            var = meta_variables.intersection(elements)
-            if var: # if not empty set
-                # extract the variable
-                var = list(var)[0]
-                # add to dictionary
-                meta_dict[var] = float(elements[-1])
+    meta_dict.update(scene_catalog.scene_metadata(info_satellite['landsat_product_id'], meta_variables,
+        info_satellite['city']))
     #
     return meta_dict
 
 
 def clip_geographic_data(info_satellite, source_city):
     '''
-        Run R code which clips in the satellite and land cover images to the city boundary
-        and projects to WGS84
+        Clip the satellite images to the city boundary (with a 2km buffer) and
+        project to WGS84
+        This is done with GDAL warps in this process (it replaces running
+        clip_geographic_data.R), and images whose source, grid, and resampling
+        have not changed are not redone (see warp_cached)
+        The city's layers are clipped first (see clip_city_layers) - usually already
+        done by schedule_images, but not when a scene is processed on its own.
+        The city's land cover is put on the scene's grid when the emissivity is
+        calculated (see scene_land_cover)
         Return
             images saved in /data/intermediate
             satellite
+    '''
+    logger.info('Clipping geographic data if necessary')
+    city = info_satellite['city']
+    clip_city_layers(city, source_city)
+    city_idx = source_city.loc[source_city['city']==city].index
+    fn_boundary = source_city['city_parcels'][city_idx].values[0]
+
+    # import city boundary and buffer it
+    fn_buffer = read_city_boundary(city, fn_boundary)
+
+    # clip the satellite bands - band 10 first as it defines the grid for the others
+    for band in CLIP_BANDS:
+        clip_satellite(info_satellite, band, fn_buffer)
+
+
+def clip_city_layers(city, source_city):
+    '''
+        Clip the city's land cover, tree canopy, impervious surface and elevation to
+        the city boundary (with a 2km buffer), in WGS84 at their own resolution
+        This is done once per city before the scenes are processed (schedule_images),
+        and is then a cache hit when each scene checks it (clip_geographic_data).
+        Each layer is warped holding a lock file, so processes never write one at
+        the same time. Scenes of a city are on
+        different grids, so each scene puts the land cover on its own grid (see
+        scene_land_cover)
+        Return
+            images saved in /data/processed
             land cover
             tree canopy
             impervious surface
+            elevation
     '''
-    logger.info('Clipping geographic data if necessary')
-    # Define command
-    command = 'Rscript'
-    path2script = 'code/processing/clip_geographic_data.R'
-    #
-    # Define arguments
-    city = info_satellite['city']
+    logger.info('Clipping the layers of {} if necessary'.format(city))
     city_idx = source_city.loc[source_city['city']==city].index
     # filename arguments
-    landsat_product_id = info_satellite['landsat_product_id']
     fn_land_cover = source_city['land_cover'][city_idx].values[0]
     fn_tree_canopy = source_city['tree_canopy'][city_idx].values[0]
     fn_impervious_surface = source_city['impervious'][city_idx].values[0]
     fn_elevation = source_city['elevation'][city_idx].values[0]
     fn_boundary = source_city['city_parcels'][city_idx].values[0]
-    bands = '1,2,3,4,5,6,7,10'
-    # args into list - order does not matter, it is sorted at the bottom of the R script
-    args_clip = [city, landsat_product_id, fn_land_cover, fn_boundary, bands, fn_tree_canopy, fn_impervious_surface, fn_elevation]
-    #
-    # Build subprocess command
-    cmd = [command, path2script] + args_clip
-    #
-    # run the R function to clip and project the data as required
-    x = subprocess.check_output(cmd, universal_newlines=True)
 
+    # import city boundary and buffer it
+    fn_buffer = read_city_boundary(city, fn_boundary)
+    # crop and mask to the buffer - the same grid for every scene
+    grid = {'dstSRS': 'EPSG:4326', 'cropToCutline': True}
 
-def calc_LST(info_satellite, meta_dict, source_city):
+    # clip the land cover, tree canopy, and impervious surface
+    for cover_type, fn_cover in [('LC', fn_land_cover), ('CAN', fn_tree_canopy), ('IMP', fn_impervious_surface)]:
+        fn_in = 'data/raw/{}/{}/{}.tif'.format(city, fn_cover, fn_cover)
+        fn_out = 'data/processed/{}/NLCD2011_{}_{}.tif'.format(city, cover_type, city)
+        with file_lock(fn_out + '.lock'):
+            warp_cached(fn_in, fn_out, grid, 'near', fn_buffer)
+
+    # clip the elevation
+    fn_in = 'data/raw/{}/{}/{}.img'.format(city, fn_elevation, fn_elevation)
+    fn_out = 'data/processed/{}/{}_elevation.tif'.format(city, city)
+    with file_lock(fn_out + '.lock'):
+        warp_cached(fn_in, fn_out, grid, 'near', fn_buffer)
+
+
+def read_city_boundary(city, fn_boundary):
     '''
-        Returns the land surface temperature (LST) based on satellite imagery
+        Import the city boundary polygon, union and buffer it, and save it
+        Return
+            filename of the buffered boundary shapefile
     '''
-    logger.info('Starting LST calculations')
+    path_city = 'data/intermediate/{}'.format(city)
+    fn_buffer = '{}/{}_buffer.shp'.format(path_city, city)
+
+    # check if processed already
+    if os.path.exists(fn_buffer):
+        return(fn_buffer)
+
+    logger.info('Buffering the city boundary')
+    # import the original
+    ds_boundary = ogr.Open('data/raw/{}/{}/{}.shp'.format(city, fn_boundary, fn_boundary))
+    layer = ds_boundary.GetLayer()
+    srs_boundary = layer.GetSpatialRef()
+
+    # union shape file
+    polygons = ogr.Geometry(ogr.wkbMultiPolygon)
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry.GetGeometryType() == ogr.wkbPolygon:
+            polygons.AddGeometry(geometry)
+        else:
+            for i in range(geometry.GetGeometryCount()):
+                polygons.AddGeometry(geometry.GetGeometryRef(i))
+    city_boundary = polygons.UnionCascaded()
+
+    # buffer by 2km in a projection in meters
+    city_buffer = city_boundary.Clone()
+    city_buffer.Transform(osr.CoordinateTransformation(srs_boundary, spatial_reference(BUFFER_EPSG)))
+    city_buffer = city_buffer.Buffer(2000)
+
+    # project all to WSG84
+    srs_wgs84 = spatial_reference(4326)
+    city_buffer.Transform(osr.CoordinateTransformation(spatial_reference(BUFFER_EPSG), srs_wgs84))
+    city_boundary.Transform(osr.CoordinateTransformation(srs_boundary, srs_wgs84))
 
-    # metadata file and location
-    city = info_satellite['city']
-    fn_b10 = 'data/intermediate/{}/{}_B10.tif'.format(info_satellite['city'], info_satellite['landsat_product_id'])
+    # save
+    os.makedirs(path_city, exist_ok=True)
+    write_polygon('{}/{}_boundary.shp'.format(path_city, city), city_boundary, srs_wgs84, city)
+    write_polygon(fn_buffer, city_buffer, srs_wgs84, city)
+    return(fn_buffer)
 
-    # read in band 10 data
-    image_b10 = gdal.Open(fn_b10)
-    dn = image_b10.ReadAsArray()
 
-    # conversion to TOA radiance
-    TOA = calc_TOA_radiance(dn, meta_dict, 10)
+def spatial_reference(epsg):
+    '''
+        Spatial reference from an epsg code, in x (lon), y (lat) order
+    '''
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        # GDAL >= 3 otherwise uses lat, lon order for geographic coordinates
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return(srs)
 
-    # write thermal radiance to tif
-    TOA_write = TOA.copy()
-    import code
-    # code.interact(local=locals())
-    TOA_write[TOA_write < 0] = np.nan
-    fn_out = 'data/processed/image/{}/{}_{}_{}.tif'.format(city, 'thermal-radiance', info_satellite['date'], info_satellite['day_night'])
-    array_to_raster(TOA_write, fn_out, image_b10)
 
-    # emissivity correction
-    emissivity = determine_emissivity(info_satellite, dn, source_city)
+def write_polygon(fn_out, geometry, srs, city):
+    '''
+        Save a polygon as a shapefile with a single city feature
+    '''
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    ds_out = driver.CreateDataSource(fn_out)
+    layer = ds_out.CreateLayer(os.path.splitext(os.path.basename(fn_out))[0], srs, ogr.wkbMultiPolygon)
+    layer.CreateField(ogr.FieldDefn('city', ogr.OFTString))
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetField('city', city)
+    feature.SetGeometry(ogr.ForceToMultiPolygon(geometry))
+    layer.CreateFeature(feature)
+    # close the dataset to write it to disk
+    ds_out = None
+
+
+def clip_satellite(info_satellite, band, fn_buffer):
+    '''
+        Clip the satellite band to the city buffer and project to WGS84
+        Bands after band 10 are put on band 10's grid, so all of the bands align
+    '''
+    fn_out = band_filename(info_satellite, band)
+    fn_raw = 'data/raw/{}/{}_B{}.tif'.format(info_satellite['city'], info_satellite['landsat_product_id'], band)
+    if band == 10:
+        # crop and mask to the buffer
+        grid = {'dstSRS': 'EPSG:4326', 'cropToCutline': True}
+        warp_cached(fn_raw, fn_out, grid, 'bilinear', fn_buffer)
+    else:
+        clip_ancillary(fn_raw, fn_out, gdal.Open(band_filename(info_satellite, 10)), fn_buffer, 'bilinear')
 
-    # calculate the at-satellite brightness temperature
-    temp_satellite = calc_satellite_temperature(TOA, meta_dict, emissivity)
 
-    # atmospheric correction
-    temp_surface = atmos_correction(temp_satellite, info_satellite, emissivity)
+def clip_ancillary(fn_in, fn_out, ds_grid, fn_buffer, resample='near'):
+    '''
+        Warp a raster onto the grid of ds_grid (projection, extent, and cell size)
+        and mask it to the city buffer in a single step
+        Pixels outside the buffer are NaN
+    '''
+    warp_cached(fn_in, fn_out, raster_grid(ds_grid), resample, fn_buffer)
+
+
+def raster_grid(ds_grid):
+    '''
+        The gdal.Warp options of the grid of ds_grid (projection, extent, and cell size)
+    '''
+    return({'dstSRS': ds_grid.GetProjection(), 'outputBounds': raster_bounds(ds_grid),
+            'width': ds_grid.RasterXSize, 'height': ds_grid.RasterYSize})
+
+
+def warp_cached(fn_in, fn_out, grid, resample, fn_buffer):
+    '''
+        Warp fn_in onto the target grid (gdal.Warp options), masked to the city buffer,
+        unless fn_out was already warped with the same key
+        The key (see warp_cache_key) is saved next to the output as fn_out.key, so the
+        output is redone automatically when the source file, target grid, resampling
+        method, or buffer change, and the source is not opened when nothing has changed
+        Each output has a single writer: the scene's bands are written by the process
+        of the scene, and the city's layers holding a lock (clip_city_layers). Rasters
+        shared by the scenes of a city are cached with cache_file instead
+        Return
+            True if the raster was warped, False if the cached raster was used
+    '''
+    key = warp_cache_key(fn_in, grid, resample, fn_buffer)
+    fn_key = fn_out + '.key'
+
+    # check if processed already
+    if os.path.exists(fn_out) and os.path.exists(fn_key):
+        with open(fn_key, 'r') as fid:
+            if fid.read() == key:
+                return(False)
+
+    logger.info('Warping {} to {}'.format(fn_in, fn_out))
+    # write to a temporary file, so other processes never read a partial raster
+    fn_temp = '{}.{}.tmp.tif'.format(os.path.splitext(fn_out)[0], os.getpid())
+    gdal.Warp(fn_temp, fn_in, format='GTiff', cutlineDSName=fn_buffer, resampleAlg=resample,
+        outputType=gdal.GDT_Float32, dstNodata=np.nan, multithread=True, **grid)
+    os.replace(fn_temp, fn_out)
+    with open(fn_key, 'w') as fid:
+        fid.write(key)
+    return(True)
+
+
+def warp_cache_key(fn_in, grid, resample, fn_buffer):
+    '''
+        Key of a warp: the source and buffer files (path, size, and modified time),
+        the target grid definition, and the resampling method
+    '''
+    def file_id(fn):
+        stat = os.stat(fn)
+        return([os.path.abspath(fn), stat.st_size, stat.st_mtime])
+    key = {'source': file_id(fn_in), 'buffer': None if fn_buffer is None else file_id(fn_buffer),
+            'grid': grid, 'resample': resample}
+    return(hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest())
+
 
-    # write to tif
-    fn_out = 'data/processed/image/{}/{}_{}_{}.tif'.format(city, 'lst', info_satellite['date'], info_satellite['day_night'])
-    array_to_raster(temp_surface, fn_out, image_b10)
+def cache_file(fn_out, create):
+    '''
+        Create fn_out with create(fn_temp), unless it already exists
+        fn_out is named by the key of its inputs, so an existing file is up to date.
+        A lock file makes sure only one process creates it, while the others wait
+        for it, and the finished file is moved into place before it is ever opened
+        Return
+            fn_out
+    '''
+    if os.path.exists(fn_out):
+        return(fn_out)
+    os.makedirs(os.path.dirname(fn_out), exist_ok=True)
+    with file_lock(fn_out + '.lock'):
+        # another process may have created it while this one waited
+        if not os.path.exists(fn_out):
+            fn_temp = '{}.{}.tmp.tif'.format(os.path.splitext(fn_out)[0], os.getpid())
+            create(fn_temp)
+            os.replace(fn_temp, fn_out)
+    return(fn_out)
+
+
+@contextmanager
+def file_lock(fn_lock, timeout=LOCK_TIMEOUT):
+    '''
+        Hold the lock file for the duration of the context, waiting for any other
+        process holding it
+    '''
+    while True:
+        try:
+            fd = os.open(fn_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                # a lock left by a process which died
+                if time.time() - os.path.getmtime(fn_lock) > timeout:
+                    os.remove(fn_lock)
+                    continue
+            except OSError:
+                # released in the meantime
+                continue
+            time.sleep(0.5)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(fn_lock)
+
+
+def raster_bounds(ds):
+    '''
+        The (min x, min y, max x, max y) bounds of a north-up raster
+    '''
+    x_min, x_res, _, y_max, _, y_res = ds.GetGeoTransform()
+    return((x_min, y_max + y_res*ds.RasterYSize, x_min + x_res*ds.RasterXSize, y_max))
+
+
+def calc_LST(info_satellite, meta_dict, source_city):
+    '''
+        Returns the land surface temperature (LST) based on satellite imagery
+    '''
+    logger.info('Starting LST calculations')
+
+    # the thermal radiance and lst share the band 10 read
+    calc_products(info_satellite, meta_dict, source_city, ['thermal-radiance', 'lst'])
 
 
 def calc_TOA_radiance(dn, meta_dict, band_number):
@@ -216,9 +893,11 @@ def calc_TOA_radiance(dn, meta_dict, band_number):
         calibrated standard product pixel value)
         https://www.usgs.gov/land-resources/nli/landsat/using-usgs-landsat-level-1-data-product
     '''
-    logger.info('Calculating TOA radiance')
+    logger.debug('Calculating TOA radiance')
 
-    TOAr = meta_dict['RADIANCE_MULT_BAND_{}'.format(band_number)] * dn + meta_dict['RADIANCE_ADD_BAND_{}'.format(band_number)]
+    # a float dn keeps its type - integers are converted to float64
+    TOAr = dn * meta_dict['RADIANCE_MULT_BAND_{}'.format(band_number)]
+    TOAr += meta_dict['RADIANCE_ADD_BAND_{}'.format(band_number)]
 
     return(TOAr)
 
@@ -227,12 +906,13 @@ def calc_TOA_reflectance(dn, meta_dict, band_number):
         Calculate the Top Atmosphere Spectral Reflectance
         https://www.usgs.gov/land-resources/nli/landsat/using-usgs-landsat-level-1-data-product
     '''
-    logger.info('Calculating TOA reflectance')
+    logger.debug('Calculating TOA reflectance')
 
     # planetary reflectance without solar angle correction
-    TOA_uncorrected = meta_dict['REFLECTANCE_MULT_BAND_{}'.format(band_number)] * dn + meta_dict['REFLECTANCE_ADD_BAND_{}'.format(band_number)]
+    reflect = dn * meta_dict['REFLECTANCE_MULT_BAND_{}'.format(band_number)]
+    reflect += meta_dict['REFLECTANCE_ADD_BAND_{}'.format(band_number)]
     # correct for solar angle
-    reflect = TOA_uncorrected/np.sin(np.radians(meta_dict['SUN_ELEVATION']))
+    reflect /= float(np.sin(np.radians(meta_dict['SUN_ELEVATION'])))
 
 
     return(reflect)
@@ -246,38 +926,140 @@ def determine_emissivity(info_satellite, dn, source_city):
     '''
     logger.info('Determining emissivity map')
 
-    city = info_satellite['city']
+    return(load_emissivity(cache_emissivity(info_satellite, source_city)))
 
-    # filename for land cover
-    city_idx = source_city.loc[source_city['city']==info_satellite['city']].index
+
+def land_cover_filename(info_satellite, source_city):
+    '''
+        Filename of the land cover image clipped to the city (see clip_city_layers)
+    '''
+    city = info_satellite['city']
+    city_idx = source_city.loc[source_city['city']==city].index
     landcover_id = source_city['land_cover'][city_idx].values[0]
     fn_landcover = '_'.join(landcover_id.split('_',2)[:2] + [city])
-    fn_land_cover = 'data/processed/{}/{}.tif'.format(city, fn_landcover)
-    print(fn_land_cover)
+    return('data/processed/{}/{}.tif'.format(city, fn_landcover))
 
-    # import
-    land_cover = gdal.Open(fn_land_cover)
 
-    # convert to array
-    land_cover = land_cover.ReadAsArray()
-    logger.info("LC tif size: " + str(np.shape(land_cover)))
-    land_cover = land_cover.astype(float)
-    emissivity = land_cover.copy()
+def emissivity_lut(emissivity_table=None, dtype=np.float64):
+    '''
+        Lookup table from land cover class code (0-255) to emissivity
+        emissivity_table: optional dictionary of class code to emissivity, which
+            replaces the default emissivity for those classes
+        dtype: of the emissivity - float64, so it is exact for the float64 products,
+            and cast to the precision of the calculations where it is used
+    '''
+    lut = np.zeros(256, dtype=dtype)
+    for class_min, class_max, emissivity in EMISSIVITY_CLASSES:
+        lut[class_min:class_max] = emissivity
+    if emissivity_table is not None:
+        for class_code, emissivity in emissivity_table.items():
+            lut[int(class_code)] = emissivity
+    return(lut)
+
+
+def read_emissivity_table(info_satellite, source_city):
+    '''
+        Read the city's class to emissivity table, if one is given in the
+        (optional) emissivity_table column of data_source_city.csv
+        The table is a csv with columns land_cover and emissivity
+        Return
+            Dictionary of class code to emissivity, or None
+    '''
+    if 'emissivity_table' not in source_city.columns:
+        return(None)
+    city_idx = source_city.loc[source_city['city']==info_satellite['city']].index
+    fn_table = source_city['emissivity_table'][city_idx].values[0]
+    if pd.isnull(fn_table):
+        return(None)
+    table = pd.read_csv(fn_table)
+    return(dict(zip(table['land_cover'], table['emissivity'])))
+
 
-    # convert land_cover to emissivity array
+def emissivity_from_land_cover(land_cover, lut=None):
+    '''
+        Convert a land cover array (or window of one) to emissivity with a single
+        lookup into the class to emissivity table (see emissivity_lut)
+        Negative (no data) land cover is NaN
+    '''
+    if lut is None:
+        lut = emissivity_lut()
     # land cover codes are here: https://www.mrlc.gov/nlcd11_leg.php
-    emissivity[(1 <= land_cover) & (land_cover < 20)] = 0.989 # Water
-    emissivity[(20 <= land_cover) & (land_cover < 30)] = 0.912 # Developed
-    emissivity[(30 <= land_cover) & (land_cover < 40)]  = 0.896 # Barren
-    emissivity[(40 <= land_cover) & (land_cover < 50)]  = 0.967 # Forest
-    emissivity[(50 <= land_cover) & (land_cover < 80)]  = 0.957 # Grass
-    emissivity[(80 <= land_cover) & (land_cover < 90)]  = 0.957 # Cropland
-    emissivity[90 <= land_cover] = 0.957 # Wetlands is assumed to be Sparse Vegetation
-    emissivity[land_cover < 0] = np.nan
+    if land_cover.dtype == np.uint8:
+        return(lut[land_cover])
+    valid = np.isfinite(land_cover) & (land_cover >= 0)
+    # codes above 255 take the last class, as codes >= 90 did before
+    codes = np.minimum(np.where(valid, land_cover, 0), 255).astype(np.intp)
+    emissivity = lut[codes]
+    emissivity[~valid] = np.nan
 
     return(emissivity)
 
 
+def scene_land_cover(info_satellite, source_city):
+    '''
+        Put the city's land cover on the scene's grid (band 10), unless a scene on
+        the same grid already has
+        The filename includes the key of the land cover, grid, and resampling (see
+        warp_cache_key), so scenes on the same grid share it and scenes on other
+        grids never overwrite it
+        Return
+            filename of the land cover on the scene's grid
+    '''
+    fn_land_cover = land_cover_filename(info_satellite, source_city)
+    grid = raster_grid(gdal.Open(band_filename(info_satellite, 10)))
+    key = warp_cache_key(fn_land_cover, grid, 'near', None)
+    fn_out = os.path.join(PATH_GRID_CACHE.format(info_satellite['city']), 'land_cover_{}.tif'.format(key[:16]))
+
+    def warp(fn_temp):
+        logger.info('Warping {} to {}'.format(fn_land_cover, fn_out))
+        # the city's land cover is already masked to the buffer
+        gdal.Warp(fn_temp, fn_land_cover, format='GTiff', resampleAlg='near', outputType=gdal.GDT_Float32,
+            dstNodata=np.nan, multithread=True, **grid)
+    return(cache_file(fn_out, warp))
+
+
+def cache_emissivity(info_satellite, source_city):
+    '''
+        Save the emissivity map of the scene's grid as a Float64 raster (as the lookup
+        table, see emissivity_lut), unless it is already saved
+        The filename includes a hash of the lookup table and the key of the land
+        cover on the scene's grid (see scene_land_cover), so it is recreated when
+        either changes and is shared by the scenes on the same grid
+        Return
+            filename of the emissivity map
+    '''
+    lut = emissivity_lut(read_emissivity_table(info_satellite, source_city))
+    lut_hash = hashlib.md5(lut.tobytes()).hexdigest()[:8]
+    fn_land_cover = scene_land_cover(info_satellite, source_city)
+    grid_key = os.path.splitext(os.path.basename(fn_land_cover))[0].split('_')[-1]
+    fn_emissivity = os.path.join(os.path.dirname(fn_land_cover), 'emissivity_{}_{}.tif'.format(lut_hash, grid_key))
+
+    def create(fn_temp):
+        logger.info('Creating emissivity map: {}'.format(fn_emissivity))
+        ds_land_cover = gdal.Open(fn_land_cover)
+        ds_out = create_raster(fn_temp, ds_land_cover, data_type=gdal.GDT_Float64)
+        for xoff, yoff, xsize, ysize in iter_windows(ds_land_cover, 1024):
+            land_cover = ds_land_cover.ReadAsArray(xoff, yoff, xsize, ysize)
+            ds_out.GetRasterBand(1).WriteArray(emissivity_from_land_cover(land_cover, lut), xoff, yoff)
+        # close the dataset to write it to disk
+        ds_out = None
+    return(cache_file(fn_emissivity, create))
+
+
+def load_emissivity(fn_emissivity, dtype=np.float64):
+    '''
+        Read the whole emissivity map as dtype, keeping the last one read in memory
+        so consecutive scenes on the same grid share it
+    '''
+    key = (fn_emissivity, os.path.getmtime(fn_emissivity), np.dtype(dtype).name)
+    if key not in EMISSIVITY_CACHE:
+        # release the previous map before reading this one
+        EMISSIVITY_CACHE.clear()
+        EMISSIVITY_CACHE[key] = gdal.Open(fn_emissivity).ReadAsArray().astype(dtype, copy=False)
+        logger.info("Emissivity tif size: " + str(np.shape(EMISSIVITY_CACHE[key])))
+    return(EMISSIVITY_CACHE[key])
+
+
 def calc_satellite_temperature(TOA, meta_dict, emissivity):
     '''
         Calculate the At-Satellite Brightness temperature
@@ -285,13 +1067,16 @@ def calc_satellite_temperature(TOA, meta_dict, emissivity):
         Then convert
         Returns temperature in Kelvin
     '''
-    logger.info('calculating satellite temperature')
+    logger.debug('calculating satellite temperature')
 
     # spectral radiance
     L_lam = TOA/emissivity
 
-    # calculate the satellite brightness
-    temp_satellite = meta_dict['K2_CONSTANT_BAND_10']/(np.log(1 + (meta_dict['K1_CONSTANT_BAND_10']/L_lam)))
+    # calculate the satellite brightness, K2/ln(1 + K1/L), in place
+    temp_satellite = np.divide(meta_dict['K1_CONSTANT_BAND_10'], L_lam, out=L_lam)
+    temp_satellite += 1
+    np.log(temp_satellite, out=temp_satellite)
+    np.divide(meta_dict['K2_CONSTANT_BAND_10'], temp_satellite, out=temp_satellite)
 
     return temp_satellite
 
@@ -302,10 +1087,10 @@ def atmos_correction(temp_satellite, info_satellite, emissivity):
         make the atmospheric correction
         Returns land surface temperature in celsius
     '''
-    logger.info('making the atmospheric correction')
+    logger.debug('making the atmospheric correction')
 
     # temparature from csv file
-    temp_max = info_satellite['max_temp_celsius']
+    temp_max = float(info_satellite['max_temp_celsius'])
     # convert to Kelvin
     temp_max += 273.15
 
@@ -316,12 +1101,25 @@ def atmos_correction(temp_satellite, info_satellite, emissivity):
     t_6 = 0.974290 - 0.08007*w
         # variables dependent on land cover (emissivity) and temperature
     c_6 = emissivity * t_6
-    d_6 = (1 - t_6)*(1 + (1 - emissivity)*t_6)
+    d_6 = 1 - emissivity
+    d_6 *= t_6
+    d_6 += 1
+    d_6 *= 1 - t_6
     t_a = 16.0110 + 0.92621*temp_max
 
-    # mono-window algorithm (Qin et al., 2001, page 3726)
-    T = a_6*(1 - c_6 - d_6) + (b_6*(1 - c_6 - d_6) + c_6 + d_6)*temp_satellite - d_6*t_a
-    temp_landsurface = T/c_6
+    # mono-window algorithm (Qin et al., 2001, page 3726), in place:
+    # T = a_6*(1 - c_6 - d_6) + (b_6*(1 - c_6 - d_6) + c_6 + d_6)*temp_satellite - d_6*t_a
+    cd_6 = c_6 + d_6
+    T = cd_6 * (1 - b_6)
+    T += b_6
+    T *= temp_satellite
+    cd_6 *= -a_6
+    cd_6 += a_6
+    T += cd_6
+    d_6 *= t_a
+    T -= d_6
+    temp_landsurface = T
+    temp_landsurface /= c_6
 
     # converting to celsius
     temp_landsurface -= 273.15
@@ -329,6 +1127,97 @@ def atmos_correction(temp_satellite, info_satellite, emissivity):
     return temp_landsurface
 
 
+def thermal_products(dn, emissivity, meta_dict, info_satellite, products=['thermal-radiance', 'lst'],
+        dtype=np.float64, n_threads=1, block_rows=THERMAL_BLOCK_ROWS):
+    '''
+        Calculate the thermal radiance and/or land surface temperature from band 10
+        with a fused kernel: the TOA radiance, brightness temperature and mono-window
+        correction (see calc_TOA_radiance, calc_satellite_temperature and
+        atmos_correction) are evaluated block_rows rows at a time into the
+        preallocated outputs, so the temporaries are the size of a block, not the scene
+        The blocks are shared across n_threads threads (numpy releases the GIL)
+        Return
+            Dictionary of product arrays
+    '''
+    results = dict()
+    for product in products:
+        results[product] = np.empty(dn.shape, dtype=dtype)
+
+    # constants of the mono-window algorithm (see atmos_correction)
+    temp_max = float(info_satellite['max_temp_celsius']) + 273.15
+    constants = dict(
+        mult = meta_dict['RADIANCE_MULT_BAND_10'],
+        add = meta_dict['RADIANCE_ADD_BAND_10'],
+        k1 = meta_dict['K1_CONSTANT_BAND_10'],
+        k2 = meta_dict['K2_CONSTANT_BAND_10'],
+        a_6 = -67.355351,
+        b_6 = 0.458606,
+        t_6 = 0.974290 - 0.08007*1.6,
+        t_a = 16.0110 + 0.92621*temp_max,
+        )
+
+    blocks = [slice(row, row + block_rows) for row in range(0, dn.shape[0], block_rows)]
+    def calc_block(block):
+        thermal_block(dn[block], None if emissivity is None else emissivity[block],
+            {product: out[block] for product, out in results.items()}, constants)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(calc_block, blocks))
+    else:
+        for block in blocks:
+            calc_block(block)
+
+    return(results)
+
+
+def thermal_block(dn, emissivity, out, constants):
+    '''
+        Evaluate the thermal products for a block of rows into the out arrays, with
+        four block-sized scratch arrays (see thermal_products)
+    '''
+    c = constants
+    radiance, c_6, d_6, scratch = [np.empty(dn.shape, dtype=next(iter(out.values())).dtype) for i in range(4)]
+
+    # TOA radiance
+    np.multiply(dn, c['mult'], out=radiance)
+    radiance += c['add']
+    if 'thermal-radiance' in out:
+        np.copyto(out['thermal-radiance'], radiance)
+        out['thermal-radiance'][radiance < 0] = np.nan
+    if 'lst' not in out:
+        return
+
+    # brightness temperature, K2/ln(1 + K1/(L/emissivity))
+    temp = out['lst']
+    np.divide(radiance, emissivity, out=temp)
+    np.divide(c['k1'], temp, out=temp)
+    temp += 1
+    np.log(temp, out=temp)
+    np.divide(c['k2'], temp, out=temp)
+
+    # mono-window algorithm, with r = 1 - c_6 - d_6:
+    # T = (1 + (b_6 - 1)*r)*temp_satellite + a_6*r - d_6*t_a
+    np.multiply(emissivity, c['t_6'], out=c_6)
+    np.subtract(1, emissivity, out=d_6)
+    d_6 *= c['t_6']
+    d_6 += 1
+    d_6 *= 1 - c['t_6']
+    r = radiance
+    np.subtract(1, c_6, out=r)
+    r -= d_6
+    np.multiply(r, c['b_6'] - 1, out=scratch)
+    scratch += 1
+    temp *= scratch
+    np.multiply(r, c['a_6'], out=scratch)
+    temp += scratch
+    d_6 *= c['t_a']
+    temp -= d_6
+    temp /= c_6
+
+    # converting to celsius
+    temp -= 273.15
+
+
 def calc_albedo(info_satellite, meta_dict):
     '''
         Calculate albedo from bands 1,3,4,5,7
@@ -341,25 +1230,25 @@ def calc_albedo(info_satellite, meta_dict):
     '''
     logger.info('Calculating the albedo')
 
-    # calculating the reflectivity of each band
-    reflect_band = dict()
-    for band in [1,2,3,4,5,7]:
-        fn_sat = 'data/intermediate/{}/{}_B{}.tif'.format(info_satellite['city'], info_satellite['landsat_product_id'], band)
-        ds = gdal.Open(fn_sat)
-        dn = ds.ReadAsArray()
-        reflect_band[band] = calc_TOA_reflectance(dn, meta_dict, band)
+    calc_products(info_satellite, meta_dict, None, ['albedo'])
+
 
-    # calculate the albedo
-    albedo = ((0.356*reflect_band[1]) + (0.130*reflect_band[3]) +
-            (0.373*reflect_band[4]) + (0.085*reflect_band[5]) +
-            (0.072*reflect_band[7]) - 0.0018) / 1.016
+def albedo_from_reflectance(reflect_band):
+    '''
+        Combine the reflectance of bands 1,3,4,5,7 into the albedo
+    '''
+    albedo = 0.356*reflect_band[1]
+    albedo += 0.130*reflect_band[3]
+    albedo += 0.373*reflect_band[4]
+    albedo += 0.085*reflect_band[5]
+    albedo += 0.072*reflect_band[7]
+    albedo -= 0.0018
+    albedo /= 1.016
 
     # remove no data values
     albedo[albedo < 0] = np.nan
 
-    # save
-    fn_out = 'data/processed/image/{}/{}_{}_{}.tif'.format(info_satellite['city'], 'albedo', info_satellite['date'], info_satellite['day_night'])
-    array_to_raster(albedo, fn_out, ds)
+    return(albedo)
 
 
 def calc_NDVI(info_satellite):
@@ -368,22 +1257,22 @@ def calc_NDVI(info_satellite):
         For landsat8 it's (B5 – B4) / (B5 + B4) - see Ben's email dated 7/26/16
     '''
     logger.info('Calculating the ndvi')
-    # import bands
-    landsat_band = dict()
-    for band in [1,2,3,4,5]:
-        fn_sat = 'data/intermediate/{}/{}_B{}.tif'.format(info_satellite['city'], info_satellite['landsat_product_id'], band)
-        ds = gdal.Open(fn_sat)
-        landsat_band[band] = ds.ReadAsArray()
 
-    # calculate the NDVI
-    ndvi = (landsat_band[5] - landsat_band[4])/(landsat_band[5] + landsat_band[4])
+    calc_products(info_satellite, None, None, ['ndvi'])
+
+
+def ndvi_from_bands(band_4, band_5):
+    '''
+        NDVI from the red (4) and near infrared (5) bands
+    '''
+    ndvi = band_5 - band_4
+    ndvi /= band_5 + band_4
 
     # removing no data
-    ndvi[landsat_band[band] < 0] = np.nan
+    ndvi[band_5 < 0] = np.nan
+
+    return(ndvi)
 
-    # save NVDI
-    fn_out = 'data/processed/image/{}/{}_{}_{}.tif'.format(info_satellite['city'], 'ndvi', info_satellite['date'], info_satellite['day_night'])
-    array_to_raster(ndvi, fn_out, ds)
 
 def calc_NBDI(info_satellite):
     '''
@@ -391,80 +1280,250 @@ def calc_NBDI(info_satellite):
         For landsat8 it's (B6 – B5) / (B6 + B5)
     '''
     logger.info('Calculating the nbdi')
-    # import bands
-    landsat_band = dict()
-    for band in [1,2,3,4,5,6]:
-        fn_sat = 'data/intermediate/{}/{}_B{}.tif'.format(info_satellite['city'], info_satellite['landsat_product_id'], band)
-        ds = gdal.Open(fn_sat)
-        landsat_band[band] = ds.ReadAsArray()
 
-    # calculate the NDVI
-    nbdi = (landsat_band[6] - landsat_band[5])/(landsat_band[5] + landsat_band[6])
+    calc_products(info_satellite, None, None, ['nbdi'])
+
+
+def nbdi_from_bands(band_5, band_6):
+    '''
+        NBDI from the near infrared (5) and short-wave infrared (6) bands
+    '''
+    nbdi = band_6 - band_5
+    nbdi /= band_5 + band_6
 
     # removing no data
-    nbdi[landsat_band[band] < 0] = np.nan
+    nbdi[band_6 < 0] = np.nan
 
-    # save NVDI
-    fn_out = 'data/processed/image/{}/{}_{}_{}.tif'.format(info_satellite['city'], 'nbdi', info_satellite['date'], info_satellite['day_night'])
-    array_to_raster(nbdi, fn_out, ds)
+    return(nbdi)
 
 
-def array_to_raster(output, out_filename, ds):
+def array_to_raster(output, out_filename, ds, profile=RASTER_PROFILE):
     '''
         Convert the array back to a raster
         Save the raster
     '''
-    logger.info('Calculating the albedo')
+    logger.info('Saving {}'.format(out_filename))
+
+    # create the output image
+    dataset = create_raster(out_filename, ds, output.shape[1], output.shape[0], profile)
 
-    # identify the number of pixels
-    x_pixels = output.shape[1]
-    y_pixels = output.shape[0]
+    # write the data
+    dataset.GetRasterBand(1).WriteArray(output)
+    # Write to disk
+    fn_working = close_raster(dataset, profile)
+    dataset = None
+    remove_working(fn_working)
+
+
+def create_raster(out_filename, ds, x_pixels=None, y_pixels=None, profile=RASTER_PROFILE,
+        data_type=gdal.GDT_Float32):
+    '''
+        Create an empty raster (Float32 unless data_type is given) georeferenced like ds,
+        with NaN as no data
+        By default it is the same size as ds, so it can be written to a window at a time
+        profile is one of RASTER_PROFILES (layout and compression). Finish the raster
+        with close_raster
+    '''
+    if x_pixels is None:
+        x_pixels, y_pixels = ds.RasterXSize, ds.RasterYSize
+    settings = RASTER_PROFILES[profile]
+    if settings['cog']:
+        # a cog is written to a working file then copied with its overviews first
+        out_filename = out_filename + COG_WORKING_SUFFIX
 
     # create the output image
     driver = gdal.GetDriverByName('GTiff')
-    # print driver
     dataset = driver.Create(
         out_filename,
         x_pixels,
         y_pixels,
         1,
-        gdal.GDT_Float32)
-
-    # write the data
-    dataset.GetRasterBand(1).WriteArray(output)
-    # Write to disk
-    dataset.FlushCache()
+        data_type,
+        options = settings['options'])
 
     # georeference the image and set the projection
     dataset.SetGeoTransform(ds.GetGeoTransform())
     dataset.SetProjection(ds.GetProjection())
+    dataset.GetRasterBand(1).SetNoDataValue(np.nan)
 
+    return(dataset)
 
-def image_mean(images_meta, day_night, city):
+
+def close_raster(dataset, profile=RASTER_PROFILE):
+    '''
+        Finish a raster made by create_raster: write it to disk, build the internal
+        overviews, and for a cog copy it to its final filename in the cloud optimized
+        layout (overviews and tile index at the start of the file)
+        Return
+            for a cog, the working file, to be removed with remove_working once the
+            caller has dropped its references to the dataset (else None)
+    '''
+    settings = RASTER_PROFILES[profile]
+    if settings['overviews']:
+        # halve the resolution until the overview fits in a single tile
+        factors = list()
+        factor = 2
+        while max(dataset.RasterXSize, dataset.RasterYSize) / factor >= 256:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            dataset.BuildOverviews('AVERAGE', factors)
+    dataset.FlushCache()
+
+    if settings['cog']:
+        fn_working = dataset.GetDescription()
+        fn_out = fn_working[:-len(COG_WORKING_SUFFIX)]
+        gdal.Translate(fn_out, dataset, format='GTiff',
+            creationOptions = settings['options'] + ['COPY_SRC_OVERVIEWS=YES'])
+        return(fn_working)
+    return(None)
+
+
+def remove_working(fn_working):
+    '''
+        Remove the working file of a cog (see close_raster)
+        The dataset must be closed first - an open file cannot be deleted on windows
+    '''
+    if fn_working is not None:
+        gdal.GetDriverByName('GTiff').Delete(fn_working)
+
+
+def image_mean(images_meta, day_night, city, image_types=PRODUCTS, tile_size=None,
+        statistics=MEAN_STATISTICS, percentiles=None, profile=RASTER_PROFILE, io_depth=IO_QUEUE_DEPTH):
     '''
         calculate the mean of the satellite images so that the variation in time of day is mitigated
-        import processed images
-        calculate mean
-        save
+        The images are composited a window at a time (see iter_windows), with NaN-aware
+        running statistics updated one image at a time: each window is read from one
+        date at a time, so memory does not grow with the number of images and a NaN in
+        one date does not remove the pixel
+        tile_size: the windows, as for calc_products, but a tile of MEAN_TILE_SIZE
+            rather than the whole scene when it is None
+        statistics: the running statistics to save - mean, std, count (of valid dates), min, max
+        percentiles: optional list of percentiles to save (e.g. [50] for the median).
+            These need the window from every date at once, so memory is dates x window
+        Each is saved next to the mean, e.g. lst_std_day.tif, lst_p50_day.tif
+        io_depth: windows read ahead and waiting to be written (see prefetch and write_behind)
+        Return
+            List of the records of each image type's stage (see instrumentation)
     '''
+    if percentiles is None:
+        percentiles = []
     # loop through the image types
-    image_types = ['lst', 'ndvi', 'albedo', 'thermal-radiance','nbdi']
     for image_type in image_types:
-        logger.info('Calculating the mean: {}, {}, {}'.format(city, image_type, day_night))
-        # create a dict for the images
-        images = list()
-        # loop dates
-        for date in images_meta['date']:
-            # import the image
-            fn_import = 'data/processed/image/{}/{}_{}_{}.tif'.format(city, image_type, date, day_night)
-            ds = gdal.Open(fn_import)
-            # convert to array
-            images.append(ds.ReadAsArray())
-        # take the mean
-        image_mean = np.mean(images, 0)
-        # save
-        fn_out = 'data/processed/image/{}/{}_{}_{}.tif'.format(city, image_type, 'mean', day_night)
-        array_to_raster(image_mean, fn_out, ds)
+        with stage('mean', city=city, day_night=day_night, image_type=image_type):
+            logger.info('Calculating the mean: {}, {}, {}'.format(city, image_type, day_night))
+            # open the images for each date
+            ds_images = list()
+            for date in images_meta['date']:
+                fn_import = 'data/processed/image/{}/{}_{}_{}.tif'.format(city, image_type, date, day_night)
+                ds_images.append(gdal.Open(fn_import))
+            ds_grid = ds_images[0]
+
+            # create the output rasters
+            stat_names = list(statistics) + ['p{}'.format(q) for q in percentiles]
+            ds_out = dict()
+            for stat in stat_names:
+                fn_out = 'data/processed/image/{}/{}_{}_{}.tif'.format(city, image_type, stat, day_night)
+                ds_out[stat] = create_raster(fn_out, ds_grid, profile=profile)
+
+            def read_date(item):
+                # read the window from one date
+                window, i = item
+                xoff, yoff, xsize, ysize = window
+                return(window, i, ds_images[i].ReadAsArray(xoff, yoff, xsize, ysize))
+
+            def write_window(window, results):
+                xoff, yoff, xsize, ysize = window
+                for stat in stat_names:
+                    ds_out[stat].GetRasterBand(1).WriteArray(results[stat], xoff, yoff)
+
+            # loop through the windows, and the dates of each, reading and writing in the background
+            # (on an error, the threads are stopped before it is raised)
+            windows = iter_windows(ds_grid, MEAN_TILE_SIZE if tile_size is None else tile_size)
+            items = ((window, i) for window in windows for i in range(len(ds_images)))
+            write, finish_writing = write_behind(write_window, io_depth)
+            dates = prefetch(map(read_date, items), io_depth)
+            try:
+                for window, i, image in dates:
+                    xoff, yoff, xsize, ysize = window
+                    # update the statistics one date at a time
+                    if i == 0:
+                        stats = init_running_stats((ysize, xsize))
+                        window_stack = list()
+                    update_running_stats(stats, image)
+                    if percentiles:
+                        window_stack.append(image)
+                    if i < len(ds_images) - 1:
+                        continue
+                    results = finalize_running_stats(stats)
+                    # percentiles of the window across the dates
+                    if percentiles:
+                        window_stack = np.stack(window_stack).astype(float)
+                        window_stack[~np.isfinite(window_stack)] = np.nan
+                        with warnings.catch_warnings():
+                            # pixels with no valid dates are NaN
+                            warnings.simplefilter('ignore', RuntimeWarning)
+                            for q in percentiles:
+                                results['p{}'.format(q)] = np.nanpercentile(window_stack, q, axis=0)
+                    write(window, results)
+                finish_writing()
+            finally:
+                dates.close()
+                finish_writing(discard=True)
+
+            # write to disk (dropping each dataset before its cog working file is removed)
+            for stat in stat_names:
+                dataset = ds_out.pop(stat)
+                fn_working = close_raster(dataset, profile)
+                dataset = None
+                remove_working(fn_working)
+
+    return(pop_records())
+
+
+def init_running_stats(shape):
+    '''
+        Initialise the running count, mean, sum of squared differences (m2), min, and max
+    '''
+    stats = dict()
+    stats['count'] = np.zeros(shape)
+    stats['mean'] = np.zeros(shape)
+    stats['m2'] = np.zeros(shape)
+    stats['min'] = np.full(shape, np.nan)
+    stats['max'] = np.full(shape, np.nan)
+    return(stats)
+
+
+def update_running_stats(stats, image):
+    '''
+        Add an image to the running statistics (Welford's algorithm), ignoring
+        pixels which are NaN or infinite in that image
+    '''
+    image = image.astype(float)
+    valid = np.isfinite(image)
+    values = image[valid]
+
+    stats['count'][valid] += 1
+    delta = values - stats['mean'][valid]
+    stats['mean'][valid] += delta / stats['count'][valid]
+    stats['m2'][valid] += delta * (values - stats['mean'][valid])
+    stats['min'][valid] = np.fmin(stats['min'][valid], values)
+    stats['max'][valid] = np.fmax(stats['max'][valid], values)
+
+
+def finalize_running_stats(stats):
+    '''
+        Convert the running statistics to the mean, (population) standard deviation,
+        count, min, and max. Pixels with no valid dates are NaN, except the count
+    '''
+    empty = stats['count'] == 0
+    results = dict()
+    results['count'] = stats['count']
+    results['mean'] = np.where(empty, np.nan, stats['mean'])
+    results['std'] = np.where(empty, np.nan, np.sqrt(stats['m2'] / np.maximum(stats['count'], 1)))
+    results['min'] = stats['min']
+    results['max'] = stats['max']
+    return(results)
 
 
 if __name__ == '__main__':
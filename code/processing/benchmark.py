@@ -0,0 +1,263 @@
+'''
+Benchmark the stages of L8_processing on synthetic Landsat scenes
+
+Synthetic scenes (the MTL metadata, the clipped bands, and the NLCD land cover)
+are generated at each size in a working directory, then the stages are timed
+and their peak memory recorded:
+        read_metadata, calc_LST, calc_NDVI, calc_NBDI, calc_albedo, calc_products
+        (all products in one pass), array_to_raster, and image_mean
+
+Run from the project directory (like L8_processing.py), e.g.
+        python code/processing/benchmark.py
+The results are saved as JSON, and two runs (e.g. before and after a change)
+can be compared with compare_results
+
+Memory:
+        rss_peak_mb: peak resident memory of the process (incl. GDAL's cache)
+                during the timed call, sampled by instrumentation.RssSampler
+        rss_delta_mb: the increase of that peak over the memory at the start
+        peak_python_mb: peak of the memory allocated through python (incl. numpy
+                arrays) during the stage, from tracemalloc. Tracing every allocation
+                slows the stage, so it is measured by calling the stage again,
+                after it is timed (unless trace is False)
+'''
+
+import os
+import sys
+import time
+import json
+import platform
+import tracemalloc
+import numpy as np
+import pandas as pd
+from osgeo import gdal
+from osgeo import osr
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import L8_processing
+import instrumentation
+import logging
+logger = logging.getLogger(__name__)
+
+# the scenes of each size are a city of their own, e.g. synthetic1024
+CITY = 'synthetic{}'
+# land cover classes the synthetic NLCD is drawn from
+NLCD_CLASSES = [11, 21, 22, 23, 24, 31, 41, 42, 43, 52, 71, 81, 82, 90, 95]
+# typical digital numbers of the bands (mean, standard deviation)
+BAND_DN = {1: (10000, 1500), 2: (9500, 1500), 3: (9000, 1500), 4: (9000, 2000),
+           5: (16000, 3000), 6: (14000, 3000), 7: (11000, 2500), 10: (28000, 2000)}
+
+
+def main(sizes=[1024, 4096], n_dates=3, dir_work='data/benchmark', fn_results=None, trace=True, **calc_kwargs):
+    '''
+        Benchmark the stages on synthetic scenes of each size (pixels along a side)
+        n_dates: scenes generated of each size, for image_mean
+        trace: measure peak_python_mb in a second call of each stage
+        calc_kwargs: passed to calc_products (e.g. tile_size, precision, profile, n_threads)
+        Return
+            filename of the results
+    '''
+    if fn_results is None:
+        fn_results = 'data/benchmark_{}.json'.format(time.strftime('%Y%m%d_%H%M%S'))
+    fn_results = os.path.abspath(fn_results)
+    dir_return = os.getcwd()
+    os.makedirs(dir_work, exist_ok=True)
+    # the stages read and write relative to the working directory
+    os.chdir(dir_work)
+
+    results = list()
+    try:
+        for size in sizes:
+            logger.info('Benchmarking {} x {} pixels'.format(size, size))
+            images_meta, source_city = generate_scenes(size, n_dates)
+            results += benchmark_size(size, images_meta, source_city, calc_kwargs, trace)
+    finally:
+        os.chdir(dir_return)
+
+    output = dict(
+        created = time.strftime('%Y-%m-%d %H:%M:%S'),
+        machine = platform.platform(),
+        processor = platform.processor(),
+        python = platform.python_version(),
+        numpy = np.__version__,
+        gdal = gdal.__version__,
+        settings = dict(sizes=sizes, n_dates=n_dates, trace=trace, calc_kwargs=calc_kwargs),
+        results = results,
+        )
+    with open(fn_results, 'w') as fid:
+        json.dump(output, fid, indent=2)
+    logger.info('Benchmark results saved: {}'.format(fn_results))
+
+    return(fn_results)
+
+
+def benchmark_size(size, images_meta, source_city, calc_kwargs, trace=True):
+    '''
+        Time each of the stages on the scenes of one size
+        Return
+            List of result dictionaries
+    '''
+    results = list()
+    def record(stage, function, *args, **kwargs):
+        result = measure(function, *args, trace=trace, **kwargs)
+        result.update(stage=stage, size=size)
+        logger.info('{} ({}): {:.2f} s, {:.0f} MB'.format(stage, size, result['seconds'], result['rss_peak_mb'] or 0))
+        results.append(result)
+        return(result.pop('output'))
+
+    for index, info_satellite in images_meta.iterrows():
+        meta_dict = record('read_metadata', L8_processing.read_metadata, info_satellite)
+        record('calc_LST', L8_processing.calc_LST, info_satellite, meta_dict, source_city)
+        record('calc_NDVI', L8_processing.calc_NDVI, info_satellite)
+        record('calc_NBDI', L8_processing.calc_NBDI, info_satellite)
+        record('calc_albedo', L8_processing.calc_albedo, info_satellite, meta_dict)
+        record('calc_products', L8_processing.calc_products, info_satellite, meta_dict, source_city,
+            **calc_kwargs)
+
+    # write a scene sized array
+    info_satellite = images_meta.iloc[0]
+    ds = gdal.Open(L8_processing.band_filename(info_satellite, 10))
+    output = np.random.RandomState(0).normal(size=(ds.RasterYSize, ds.RasterXSize)).astype(np.float32)
+    record('array_to_raster', L8_processing.array_to_raster, output,
+        'data/processed/image/{}/array.tif'.format(info_satellite['city']), ds)
+    del output, ds
+
+    record('image_mean', L8_processing.image_mean, images_meta, info_satellite['day_night'],
+        info_satellite['city'], tile_size=calc_kwargs.get('tile_size'))
+
+    return(results)
+
+
+def measure(function, *args, trace=True, **kwargs):
+    '''
+        Call the function, timing it and sampling its resident memory, then (if
+        trace) call it again with tracemalloc for the peak python memory
+        Return
+            Dictionary of seconds, rss_start_mb, rss_peak_mb, rss_delta_mb,
+            peak_python_mb (None unless trace), and the output of the timed call
+    '''
+    sampler = instrumentation.RssSampler()
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    rss_start, rss_peak = sampler.stop()
+
+    peak = None
+    if trace:
+        tracemalloc.start()
+        function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    # the stages' own records (see instrumentation) are not needed here
+    instrumentation.pop_records()
+
+    return(dict(seconds=seconds, rss_start_mb=rss_start, rss_peak_mb=rss_peak,
+        rss_delta_mb=None if rss_start is None else rss_peak - rss_start, peak_python_mb=peak,
+        output=output))
+
+
+def generate_scenes(size, n_dates, seed=0):
+    '''
+        Generate n_dates synthetic scenes of size x size pixels, and the city's land
+        cover, where the stages expect them (relative to the working directory)
+        Return
+            images_meta: dataframe of the scenes, as in data_source_satellite.csv
+            source_city: dataframe of the city, as in data_source_city.csv
+    '''
+    random = np.random.RandomState(seed)
+    city = CITY.format(size)
+    for directory in ['raw', 'intermediate', 'processed', 'processed/image']:
+        os.makedirs('data/{}/{}'.format(directory, city), exist_ok=True)
+
+    # land cover, in patches of 30 pixels
+    source_city = pd.DataFrame({'city': [city], 'land_cover': ['NLCD2011_LC_{}'.format(city)]})
+    patches = random.choice(NLCD_CLASSES, size=(size // 30 + 1, size // 30 + 1)).astype(np.uint8)
+    land_cover = np.kron(patches, np.ones((30, 30), dtype=np.uint8))[:size, :size]
+    write_band(land_cover, L8_processing.land_cover_filename(dict(city=city), source_city), gdal.GDT_Byte)
+
+    scenes = list()
+    for i in range(n_dates):
+        date = '201707{:02d}'.format(i + 1)
+        info_satellite = pd.Series(dict(city=city, date=date, day_night='day', include=True,
+            landsat_product_id='LC08_L1TP_000000_{}_{}_{}'.format(date, date, size),
+            max_temp_celsius=30.0 + i))
+        write_mtl(info_satellite, random)
+        for band, (mean, sd) in BAND_DN.items():
+            dn = random.normal(mean, sd, size=(size, size)).clip(1, 65535).astype(np.uint16)
+            write_band(dn, L8_processing.band_filename(info_satellite, band), gdal.GDT_UInt16)
+        scenes.append(info_satellite)
+
+    return(pd.DataFrame(scenes), source_city)
+
+
+def write_band(array, fn_out, data_type):
+    '''
+        Save the array as a GeoTIFF on a 30m UTM grid
+    '''
+    ds = gdal.GetDriverByName('GTiff').Create(fn_out, array.shape[1], array.shape[0], 1, data_type)
+    ds.SetGeoTransform((350000, 30, 0, 4350000, 0, -30))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32618)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(array)
+    ds.FlushCache()
+
+
+def write_mtl(info_satellite, random):
+    '''
+        Save a Landsat 8 MTL metadata file with the groups and fields the stages read
+    '''
+    date = info_satellite['date']
+    groups = [
+        ('PRODUCT_METADATA', [
+            ('DATE_ACQUIRED', '{}-{}-{}'.format(date[:4], date[4:6], date[6:])),
+            ('SCENE_CENTER_TIME', '"15:50:00.0000000Z"')]),
+        ('IMAGE_ATTRIBUTES', [
+            ('CLOUD_COVER', '{:.2f}'.format(random.uniform(0, 20))),
+            ('CLOUD_COVER_LAND', '{:.2f}'.format(random.uniform(0, 20))),
+            ('SUN_AZIMUTH', '{:.8f}'.format(random.uniform(110, 140))),
+            ('SUN_ELEVATION', '{:.8f}'.format(random.uniform(55, 70)))]),
+        ('RADIOMETRIC_RESCALING',
+            [('RADIANCE_MULT_BAND_{}'.format(b), '1.2E-02') for b in range(1, 8)] +
+            [('RADIANCE_MULT_BAND_10', '3.3420E-04')] +
+            [('RADIANCE_ADD_BAND_{}'.format(b), '-60.0') for b in range(1, 8)] +
+            [('RADIANCE_ADD_BAND_10', '0.10000')] +
+            [('REFLECTANCE_MULT_BAND_{}'.format(b), '2.0000E-05') for b in range(1, 8)] +
+            [('REFLECTANCE_ADD_BAND_{}'.format(b), '-0.100000') for b in range(1, 8)]),
+        ('TIRS_THERMAL_CONSTANTS', [
+            ('K1_CONSTANT_BAND_10', '774.8853'),
+            ('K2_CONSTANT_BAND_10', '1321.0789')]),
+        ]
+
+    lines = ['GROUP = L1_METADATA_FILE']
+    for group, fields in groups:
+        lines.append('  GROUP = {}'.format(group))
+        lines += ['    {} = {}'.format(field, value) for field, value in fields]
+        lines.append('  END_GROUP = {}'.format(group))
+    lines += ['END_GROUP = L1_METADATA_FILE', 'END']
+    fn_metadata = L8_processing.scene_catalog.mtl_filename(info_satellite['city'], info_satellite['landsat_product_id'])
+    with open(fn_metadata, 'w') as fid:
+        fid.write('\n'.join(lines) + '\n')
+
+
+def compare_results(fn_before, fn_after):
+    '''
+        Compare two benchmark runs
+        Return
+            Dataframe of the mean seconds and peak memory of each stage and size,
+            and the ratio of after to before
+    '''
+    means = list()
+    for fn in [fn_before, fn_after]:
+        with open(fn, 'r') as fid:
+            results = pd.DataFrame(json.load(fid)['results'])
+        columns = [i for i in ['seconds', 'rss_delta_mb', 'peak_python_mb'] if i in results.columns]
+        means.append(results.groupby(['stage', 'size'])[columns].mean())
+    comparison = means[0].join(means[1], lsuffix='_before', rsuffix='_after', how='inner')
+    for column in [i for i in ['seconds', 'rss_delta_mb', 'peak_python_mb'] if i in means[0] and i in means[1]]:
+        comparison[column + '_ratio'] = comparison[column + '_after'] / comparison[column + '_before']
+    return(comparison)
+
+
+if __name__ == '__main__':
+    main()
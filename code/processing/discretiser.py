@@ -0,0 +1,697 @@
+'''
+Aggregate the rasters of a city into a square grid
+
+Python engine for the raster data types of discretiser.R (processRaster and
+categoriseRaster), driven by the same data_to_grid_{city}.csv catalogs
+
+Input:
+        data_to_grid_{city}.csv - the first row is the city boundary (areaLevel),
+                which defines the extent of the grid and the area of each cell
+                in the city. Rows of dataType areaLevel, polyIntersect, raster
+                and rasterCategory are gridded
+Output:
+        data/processed/grid/{city}/{date}/{city}_data_{grid_size}.csv with the
+        columns x, y (cell centroid), cId, area, then for each areaLevel layer
+        its attributes (e.g. city), as areaLevel in discretiser.R
+                text: the values of the polygons in the cell, joined by &
+                numbers: the mean of the polygons in the cell, weighted by area
+        for each polyIntersect layer the area (m2) of its polygons in the cell
+                {varName} (e.g. bldg)
+        for each raster
+                {varName}_mean, _max, _min, _sd
+        and for each categorical raster the area (m2) of each class
+                {varName}_{class}
+        An existing grid (e.g. from discretiser.R, which also grids the other data
+        types) is not overwritten - the cells are saved as {city}_data_{grid_size}_py.csv
+
+Notes:
+        Each pixel is assigned to the cell its centre is in. The pixel to cell index
+        is calculated once per raster grid (geotransform and size) and cell size,
+        and the statistics of every raster on that grid are then bincount and
+        reduceat reductions over it, rather than a polygon extraction per cell
+        The polygons of an areaLevel layer are rasterized once, by their number, at
+        BOUNDARY_SUBCELLS subcells along the side of a cell to find their area in
+        each cell. Those of a polyIntersect layer are intersected with the cells
+        they overlap
+        Other data types (e.g. pointCount, lineLength) are not gridded here - use discretiser.R
+        The spatial lag ({column}_sl) of each column is added by spatial_lag.py
+        The statistics are kept per cell in a mergeable form (count, sum, squared
+        deviations, min, max, class and polygon areas), so grid_city_multiscale derives coarser
+        grids (e.g. 200, 500, 1000m) exactly from a fine one without reading the rasters
+'''
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+import os
+import time
+import pickle
+import hashlib
+import json
+import spatial_lag
+
+# init logging
+import sys
+sys.path.append("code")
+from logger_config import *
+logger = logging.getLogger(__name__)
+
+PATH_GRIDDED = 'data/processed/grid'
+PATH_CATALOG = 'code/processing'
+PATH_TEMP = 'data/intermediate'
+
+# statistics of each raster in a cell (the order of the columns, as discretiser.R)
+RASTER_STATISTICS = ['mean', 'max', 'min', 'sd']
+# the boundary is rasterized at this many subcells along the side of a cell to find its area
+BOUNDARY_SUBCELLS = 10
+# the data types gridded here
+DATA_TYPES = ['areaLevel', 'polyIntersect', 'raster', 'rasterCategory']
+# change to recompute the cached statistics after changing their form (grid_statistics)
+STATISTICS_VERSION = 2
+# suffix of the filename of the cells, if the grid already exists
+SUFFIX_EXISTING = '_py'
+
+# pixel to cell indices of the process, keyed by the raster grid and cell size
+CELL_INDEX_CACHE = dict()
+
+
+def main(grid_size=500, cities=['bal','det','phx','por'], statistics=RASTER_STATISTICS, category_statistic='area'):
+    '''
+        Grid the rasters of each city
+    '''
+    for city in cities:
+        grid_city(city, grid_size, statistics, category_statistic)
+
+
+def grid_city(city, grid_size, statistics=RASTER_STATISTICS, category_statistic='area', date_str=None):
+    '''
+        Grid the rasters in the city's catalog
+        statistics: of each raster within a cell - mean, max, min, sd, count, fraction
+            (fraction of the cell's pixels which have data)
+        category_statistic: of each class of a categorical raster - area (m2) or
+            fraction (of the cell's pixels)
+        Return
+            Dataframe of the cells
+    '''
+    logger.info('Gridding the data for {} at {}m'.format(city, grid_size))
+    grid, area, layers = grid_statistics(city, grid_size)
+    cells = statistics_table(grid, area, layers, statistics, category_statistic)
+    save_cells(cells, city, grid_size, date_str)
+    return(cells)
+
+
+def grid_city_multiscale(city, fine_size=100, grid_sizes=[200, 500, 1000], statistics=RASTER_STATISTICS,
+        category_statistic='area', date_str=None, refresh=False):
+    '''
+        Grid the rasters at each of grid_sizes, by combining the statistics of the
+        cells of a fine grid (see grid_statistics and coarsen_statistics), so the
+        rasters are only read once
+        The fine statistics are saved in data/intermediate/{city}, named by the key
+        of their inputs (see statistics_cache_key), and reused unless refresh is True
+        Each grid size must be a multiple of fine_size. The coarse grids share the
+        fine grid's top left corner, so they can be offset from a grid made from
+        scratch at that size (which is centred on the boundary)
+        Return
+            Dictionary of grid size to the dataframe of its cells
+    '''
+    key = statistics_cache_key(city, fine_size, statistics, category_statistic)
+    fn_statistics = os.path.join(PATH_TEMP, city, 'grid_statistics_{}_{}.pkl'.format(fine_size, key))
+    if os.path.exists(fn_statistics) and not refresh:
+        with open(fn_statistics, 'rb') as fid:
+            grid, area, layers = pickle.load(fid)
+    else:
+        logger.info('Gridding the statistics for {} at {}m'.format(city, fine_size))
+        grid, area, layers = grid_statistics(city, fine_size)
+        os.makedirs(os.path.dirname(fn_statistics), exist_ok=True)
+        with open(fn_statistics, 'wb') as fid:
+            pickle.dump((grid, area, layers), fid)
+
+    grids = dict()
+    for grid_size in grid_sizes:
+        if grid_size % fine_size:
+            raise ValueError('The grid size {} is not a multiple of {}'.format(grid_size, fine_size))
+        logger.info('Aggregating {} to {}m from {}m'.format(city, grid_size, fine_size))
+        grid_coarse, area_coarse, layers_coarse = coarsen_statistics(grid, area, layers, grid_size // fine_size)
+        cells = statistics_table(grid_coarse, area_coarse, layers_coarse, statistics, category_statistic)
+        save_cells(cells, city, grid_size, date_str)
+        grids[grid_size] = cells
+
+    return(grids)
+
+
+def statistics_cache_key(city, grid_size, statistics=RASTER_STATISTICS, category_statistic='area'):
+    '''
+        Key of the gridded statistics: their version, the catalog and the files of
+        its rows (path, size, and modified time), the grid size, and the statistics
+    '''
+    def file_id(fn):
+        if not os.path.exists(fn):
+            return([os.path.abspath(fn), None, None])
+        stat = os.stat(fn)
+        return([os.path.abspath(fn), stat.st_size, stat.st_mtime])
+    fn_catalog = os.path.join(PATH_CATALOG, 'data_to_grid_{}.csv'.format(city))
+    sources = list()
+    for index, data_row in read_catalog(city).iterrows():
+        fn = data_filename(data_row)
+        sources.append(file_id(fn))
+        if data_row['fileType'] == '.shp':
+            # the attributes of the polygons
+            sources.append(file_id(os.path.splitext(fn)[0] + '.dbf'))
+    key = {'version': STATISTICS_VERSION, 'catalog': file_id(fn_catalog), 'sources': sources, 'grid_size': grid_size,
+            'statistics': list(statistics), 'category_statistic': category_statistic}
+    return(hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16])
+
+
+def grid_statistics(city, grid_size):
+    '''
+        The mergeable statistics of each layer in the city's catalog in each cell
+        (see area_level_statistics, intersect_statistics, raster_statistics and
+        category_statistics)
+        Return
+            grid: see create_grid
+            area: area (m2) of each cell within the boundary
+            layers: list of (varName, dataType, statistics)
+    '''
+    catalog = read_catalog(city)
+
+    # the grid covers the boundary (the first row)
+    grid = create_grid(catalog.iloc[0], grid_size)
+    area = boundary_area(catalog.iloc[0], grid)
+    n_cells = grid['n_row'] * grid['n_col']
+
+    layers = list()
+    for index, data_row in catalog.iterrows():
+        logger.info('Processing #{}: {}'.format(index, data_row['FileName']))
+        if data_row['dataType'] not in DATA_TYPES:
+            logger.warning('{} is {} data, which is only gridded by discretiser.R'.format(
+                data_row['FileName'], data_row['dataType']))
+            continue
+        if data_row['dataType'] == 'areaLevel':
+            layers.append((data_row['varName'], data_row['dataType'], area_level_statistics(data_row, grid)))
+            continue
+        if data_row['dataType'] == 'polyIntersect':
+            layers.append((data_row['varName'], data_row['dataType'], intersect_statistics(data_row, grid)))
+            continue
+        ds = warp_to_grid(data_row, grid)
+        values = read_values(ds)
+        index = cell_index(ds, grid)
+        if data_row['dataType'] == 'raster':
+            layer = raster_statistics(values, index, n_cells)
+        else:
+            geotransform = ds.GetGeoTransform()
+            layer = category_statistics(values, index, n_cells, abs(geotransform[1] * geotransform[5]))
+        layers.append((data_row['varName'], data_row['dataType'], layer))
+
+    return(grid, area, layers)
+
+
+def statistics_table(grid, area, layers, statistics=RASTER_STATISTICS, category_statistic='area', lag=True):
+    '''
+        The table of cells, with the statistics of each layer
+        lag: add the spatial lag (queen neighbours within the city) of each column,
+            as {column}_sl (see spatial_lag)
+        Return
+            Dataframe of x, y, cId, area, and the layers' columns
+    '''
+    cells = grid_cells(grid)
+    cells['area'] = area
+    for var_name, data_type, layer in layers:
+        if data_type == 'areaLevel':
+            columns = area_level_columns(layer, exclude=cells.columns)
+        elif data_type == 'polyIntersect':
+            columns = {var_name: layer['area']}
+        elif data_type == 'raster':
+            columns = raster_columns(var_name, layer, statistics)
+        else:
+            columns = category_columns(var_name, layer, category_statistic)
+        for column, values in columns.items():
+            cells[column] = values
+    if lag:
+        cells = spatial_lag.spatial_lag(cells, grid_size=grid['size'], mask=cells['area'] > 0)
+    return(cells)
+
+
+def save_cells(cells, city, grid_size, date_str=None, overwrite=False):
+    '''
+        Save the cells as data/processed/grid/{city}/{date}/{city}_data_{grid_size}.csv
+        If that exists (e.g. from discretiser.R) and overwrite is False, the cells
+        are saved as {city}_data_{grid_size}_py.csv instead
+        Return
+            The filename of the cells
+    '''
+    if date_str is None:
+        date_str = time.strftime('%Y-%m-%d')
+    dir_save = os.path.join(PATH_GRIDDED, city, date_str)
+    os.makedirs(dir_save, exist_ok=True)
+    fn_out = os.path.join(dir_save, '{}_data_{}.csv'.format(city, grid_size))
+    if os.path.exists(fn_out) and not overwrite:
+        logger.warning('{} exists, so the cells are saved alongside it'.format(fn_out))
+        fn_out = os.path.join(dir_save, '{}_data_{}{}.csv'.format(city, grid_size, SUFFIX_EXISTING))
+    cells.to_csv(fn_out)
+    logger.info('Saved {}'.format(fn_out))
+    return(fn_out)
+
+
+def read_catalog(city):
+    '''
+        The city's data_to_grid catalog, without empty rows
+    '''
+    catalog = pd.read_csv(os.path.join(PATH_CATALOG, 'data_to_grid_{}.csv'.format(city)))
+    catalog = catalog.dropna(how='all')
+    return(catalog.loc[catalog['City'] == city].reset_index(drop=True))
+
+
+def data_filename(data_row):
+    '''
+        Filename of the catalog row's data
+    '''
+    return(os.path.join('data', data_row['Path'], data_row['City'], data_row['FileName'] + data_row['fileType']))
+
+
+def create_grid(boundary_row, grid_size):
+    '''
+        A grid of square cells covering the boundary, in the boundary row's projection
+        The grid is centred on the boundary's extent, as createGrid in discretiser.R
+        Return
+            Dictionary of epsg, size, x_min, y_max (outer edges), n_col, n_row
+    '''
+    epsg = int(boundary_row['projection_epsg'])
+    x_min, x_max, y_min, y_max = np.inf, -np.inf, np.inf, -np.inf
+    for feature, geometry in read_features(boundary_row, epsg):
+        envelope = geometry.GetEnvelope()
+        x_min, x_max = min(x_min, envelope[0]), max(x_max, envelope[1])
+        y_min, y_max = min(y_min, envelope[2]), max(y_max, envelope[3])
+
+    x_range, y_range = x_max - x_min, y_max - y_min
+    n_col = int(np.ceil(x_range / grid_size))
+    n_row = int(np.ceil(y_range / grid_size))
+    # the bottom left centroid is offset by half the remainder, as in discretiser.R
+    x_left = x_min + (x_range % grid_size) / 2 - grid_size / 2
+    y_bottom = y_min + (y_range % grid_size) / 2 - grid_size / 2
+    return(dict(epsg=epsg, size=grid_size, x_min=x_left, y_max=y_bottom + n_row * grid_size,
+        n_col=n_col, n_row=n_row))
+
+
+def read_features(data_row, epsg):
+    '''
+        The features of the catalog row's polygons, with their geometry projected to the EPSG code
+        Yield
+            feature, geometry
+    '''
+    ds = ogr.Open(data_filename(data_row))
+    layer = ds.GetLayer()
+    srs = layer.GetSpatialRef().Clone()
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(srs, epsg_reference(epsg))
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        geometry.Transform(transform)
+        yield(feature, geometry)
+
+
+def epsg_reference(epsg):
+    '''
+        Spatial reference of an EPSG code (in x, y order)
+    '''
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return(srs)
+
+
+def grid_cells(grid):
+    '''
+        The cells of the grid, ordered by row from the top left
+        Return
+            Dataframe of x, y (centroid) and cId (from 1)
+    '''
+    row, col = np.divmod(np.arange(grid['n_row'] * grid['n_col']), grid['n_col'])
+    cells = pd.DataFrame({'x': grid['x_min'] + (col + 0.5) * grid['size'],
+                          'y': grid['y_max'] - (row + 0.5) * grid['size']})
+    cells['cId'] = np.arange(1, len(cells) + 1)
+    cells.index = cells['cId'].values
+    return(cells)
+
+
+def grid_bounds(grid):
+    '''
+        The outer edges of the grid (x_min, y_min, x_max, y_max)
+    '''
+    return((grid['x_min'], grid['y_max'] - grid['n_row'] * grid['size'],
+        grid['x_min'] + grid['n_col'] * grid['size'], grid['y_max']))
+
+
+def boundary_area(boundary_row, grid):
+    '''
+        Area (m2) of each cell which is within the boundary, from the boundary
+        rasterized at BOUNDARY_SUBCELLS subcells along the side of each cell
+    '''
+    n = BOUNDARY_SUBCELLS
+    ds = gdal.GetDriverByName('MEM').Create('', grid['n_col'] * n, grid['n_row'] * n, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform((grid['x_min'], grid['size'] / n, 0, grid['y_max'], 0, -grid['size'] / n))
+    ds.SetProjection(epsg_reference(grid['epsg']).ExportToWkt())
+    ds_boundary = ogr.Open(data_filename(boundary_row))
+    gdal.RasterizeLayer(ds, [1], ds_boundary.GetLayer(), burn_values=[1])
+    inside = ds.ReadAsArray().astype(np.float64)
+
+    # sum the subcells of each cell
+    inside = inside.reshape(grid['n_row'], n, grid['n_col'], n).sum(axis=(1, 3))
+    return(inside.ravel() * (grid['size'] / n)**2)
+
+
+def area_level_statistics(data_row, grid):
+    '''
+        Mergeable statistics of the polygons of an areaLevel layer (e.g. the city
+        boundary, or neighbourhoods) in each cell
+        The polygons are rasterized once, by their number, at BOUNDARY_SUBCELLS
+        subcells along the side of a cell (as boundary_area), and the subcells of
+        each polygon in each cell are counted in one pass. Where polygons
+        overlap, a subcell is counted for the last of them
+        Return
+            Dictionary of
+                attributes: dataframe of the polygons' attributes
+                n_cells: the number of cells
+                cell, polygon, area: the area (m2) of each polygon in each cell it is in
+    '''
+    n = BOUNDARY_SUBCELLS
+    n_cells = grid['n_row'] * grid['n_col']
+    ds_polygons = ogr.Open(data_filename(data_row))
+    layer = ds_polygons.GetLayer()
+
+    # a copy of the polygons with their number (from 1) to burn
+    ds_numbered = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer_numbered = ds_numbered.CreateLayer('numbered', srs=layer.GetSpatialRef())
+    layer_numbered.CreateField(ogr.FieldDefn('number', ogr.OFTInteger))
+    attributes = list()
+    for feature in layer:
+        attributes.append(feature.items())
+        numbered = ogr.Feature(layer_numbered.GetLayerDefn())
+        numbered.SetField('number', len(attributes))
+        if feature.GetGeometryRef() is not None:
+            numbered.SetGeometry(feature.GetGeometryRef().Clone())
+        layer_numbered.CreateFeature(numbered)
+    n_polygons = len(attributes)
+
+    ds = gdal.GetDriverByName('MEM').Create('', grid['n_col'] * n, grid['n_row'] * n, 1, gdal.GDT_Int32)
+    ds.SetGeoTransform((grid['x_min'], grid['size'] / n, 0, grid['y_max'], 0, -grid['size'] / n))
+    ds.SetProjection(epsg_reference(grid['epsg']).ExportToWkt())
+    gdal.RasterizeLayer(ds, [1], layer_numbered, options=['ATTRIBUTE=number'])
+    number = ds.ReadAsArray()
+
+    # the subcells of each cell in a row, then count each (cell, number) pair in a polygon
+    number = number.reshape(grid['n_row'], n, grid['n_col'], n).transpose(0, 2, 1, 3).reshape(n_cells, n * n)
+    # (counted with unique rather than bincount, which would need cells x polygons counts)
+    pairs = np.arange(n_cells, dtype=np.int64)[:, None] * (n_polygons + 1) + number
+    pairs = pairs[number > 0]
+    del number
+    pairs, counts = np.unique(pairs, return_counts=True)
+    cell, polygon = np.divmod(pairs, n_polygons + 1)
+    return(dict(attributes=pd.DataFrame(attributes), n_cells=n_cells, cell=cell,
+        polygon=polygon - 1, area=counts * (grid['size'] / n)**2))
+
+
+def area_level_columns(layer, exclude=()):
+    '''
+        The attributes of the areaLevel polygons in each cell, as areaLevel in discretiser.R
+        text: the values of the polygons in the cell, joined by & ('' if there are none)
+        numbers: the mean of the polygons in the cell, weighted by their area (NaN if there are none)
+        exclude: attributes which are not added (those already in the table)
+        Return
+            Dictionary of column name (the attribute) to values of each cell
+    '''
+    n_cells = layer['n_cells']
+    cell, polygon, area = layer['cell'], layer['polygon'], layer['area']
+    # the polygons of each cell, in order (area_level_statistics and coarsen_statistics sort by cell)
+    cells, starts, n_in_cell = np.unique(cell, return_index=True, return_counts=True)
+    columns = dict()
+    for name in layer['attributes'].columns:
+        if name in exclude:
+            continue
+        values = layer['attributes'][name]
+        if np.issubdtype(values.dtype, np.number):
+            values = values.values.astype(np.float64)
+            valid = np.isfinite(values[polygon])
+            total = np.bincount(cell[valid], weights=area[valid], minlength=n_cells)
+            weighted = np.bincount(cell[valid], weights=area[valid] * values[polygon][valid], minlength=n_cells)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                columns[name] = np.where(total > 0, weighted / total, np.nan)
+        else:
+            text = np.array(['' if pd.isnull(v) else str(v) for v in values], dtype=object)
+            column = np.full(n_cells, '', dtype=object)
+            # cells in a single polygon take its text, the others join the texts of theirs
+            single = n_in_cell == 1
+            column[cells[single]] = text[polygon[starts[single]]]
+            for i in np.flatnonzero(~single):
+                parts = text[polygon[starts[i]:starts[i] + n_in_cell[i]]]
+                column[cells[i]] = '&'.join(part for part in parts if part)
+            columns[name] = column
+    return(columns)
+
+
+def intersect_statistics(data_row, grid):
+    '''
+        Mergeable statistics of the polygons of a polyIntersect layer (e.g. building
+        footprints) in each cell, as areaInGrid in discretiser.R
+        A polygon within a cell adds its area to the cell, otherwise it is intersected
+        with each cell its extent overlaps
+        Return
+            Dictionary of area: area (m2) of the polygons in each cell
+    '''
+    x_min, y_min, x_max, y_max = grid_bounds(grid)
+    size = grid['size']
+    area = np.zeros(grid['n_row'] * grid['n_col'])
+    for feature, geometry in read_features(data_row, grid['epsg']):
+        if not geometry.IsValid():
+            # address geometry issues, as gBuffer(width=0) in discretiser.R
+            geometry = geometry.Buffer(0)
+        envelope = geometry.GetEnvelope()
+        col_min = max(int(np.floor((envelope[0] - x_min) / size)), 0)
+        col_max = min(int(np.floor((envelope[1] - x_min) / size)), grid['n_col'] - 1)
+        row_min = max(int(np.floor((y_max - envelope[3]) / size)), 0)
+        row_max = min(int(np.floor((y_max - envelope[2]) / size)), grid['n_row'] - 1)
+        if col_min > col_max or row_min > row_max:
+            continue
+        if col_min == col_max and row_min == row_max and x_min <= envelope[0] and envelope[1] <= x_max \
+                and y_min <= envelope[2] and envelope[3] <= y_max:
+            area[row_min * grid['n_col'] + col_min] += geometry.GetArea()
+            continue
+        for row in range(row_min, row_max + 1):
+            for col in range(col_min, col_max + 1):
+                cell = cell_polygon(x_min + col * size, y_max - (row + 1) * size, size)
+                area[row * grid['n_col'] + col] += geometry.Intersection(cell).GetArea()
+    return(dict(area=area))
+
+
+def cell_polygon(x, y, size):
+    '''
+        The square cell with bottom left corner x, y
+    '''
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x_corner, y_corner in [(x, y), (x + size, y), (x + size, y + size), (x, y + size), (x, y)]:
+        ring.AddPoint_2D(x_corner, y_corner)
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+    return(polygon)
+
+
+def warp_to_grid(data_row, grid, resample='near'):
+    '''
+        Project the raster to the grid's projection, cropped to the grid, at its
+        own resolution
+        Return
+            In memory dataset
+    '''
+    return(gdal.Warp('', data_filename(data_row), format='MEM', dstSRS='EPSG:{}'.format(grid['epsg']),
+        outputBounds=grid_bounds(grid), resampleAlg=resample, dstNodata=np.nan,
+        outputType=gdal.GDT_Float64))
+
+
+def read_values(ds):
+    '''
+        The raster values, with no data as NaN
+    '''
+    values = ds.GetRasterBand(1).ReadAsArray().astype(np.float64)
+    nodata = ds.GetRasterBand(1).GetNoDataValue()
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    return(values.ravel())
+
+
+def cell_index(ds, grid):
+    '''
+        The cell (0 to n_cells-1, or -1 outside the grid) of each pixel of the dataset,
+        from the pixel's centre, with the pixels sorted by cell for reductions
+        The index is kept for the process, and is shared by rasters on the same grid
+        Return
+            Dictionary of
+                cell: cell of each pixel
+                order: pixels in the grid, sorted by cell
+                cells: the cells which contain pixels
+                starts: position in order of the first pixel of each of cells
+    '''
+    geotransform = ds.GetGeoTransform()
+    key = (geotransform, ds.RasterXSize, ds.RasterYSize, tuple(sorted(grid.items())))
+    if key in CELL_INDEX_CACHE:
+        return(CELL_INDEX_CACHE[key])
+
+    # pixel centres
+    x = geotransform[0] + (np.arange(ds.RasterXSize) + 0.5) * geotransform[1]
+    y = geotransform[3] + (np.arange(ds.RasterYSize) + 0.5) * geotransform[5]
+    col = np.floor((x - grid['x_min']) / grid['size']).astype(np.int64)
+    row = np.floor((grid['y_max'] - y) / grid['size']).astype(np.int64)
+    col[(col < 0) | (col >= grid['n_col'])] = -1
+    row[(row < 0) | (row >= grid['n_row'])] = -1
+    cell = row[:, None] * grid['n_col'] + col[None, :]
+    cell[(row[:, None] < 0) | (col[None, :] < 0)] = -1
+    cell = cell.ravel()
+
+    inside = np.flatnonzero(cell >= 0)
+    order = inside[np.argsort(cell[inside], kind='mergesort')]
+    cells, starts = np.unique(cell[order], return_index=True)
+
+    index = dict(cell=cell, order=order, cells=cells, starts=starts)
+    CELL_INDEX_CACHE[key] = index
+    return(index)
+
+
+def raster_statistics(values, index, n_cells):
+    '''
+        Mergeable statistics of the values within each cell, ignoring NaN
+        count, sum, m2 (sum of squared deviations from the cell's mean, which merges
+        exactly and without the cancellation of a raw sum of squares), min, max,
+        and pixels (the cell's pixels, with or without values)
+    '''
+    cell = index['cell']
+    valid = (cell >= 0) & np.isfinite(values)
+    cell_valid = cell[valid]
+    values_valid = values[valid]
+
+    layer = dict()
+    layer['count'] = np.bincount(cell_valid, minlength=n_cells).astype(np.float64)
+    layer['sum'] = np.bincount(cell_valid, weights=values_valid, minlength=n_cells)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = layer['sum'] / layer['count']
+    layer['m2'] = np.bincount(cell_valid, weights=(values_valid - mean[cell_valid])**2, minlength=n_cells)
+    layer['pixels'] = np.bincount(cell[cell >= 0], minlength=n_cells).astype(np.float64)
+    # min and max, from the pixels sorted by cell (NaN is ignored by fmin and fmax)
+    layer['min'] = reduce_cells(np.fmin, values[index['order']], index['cells'], index['starts'], n_cells)
+    layer['max'] = reduce_cells(np.fmax, values[index['order']], index['cells'], index['starts'], n_cells)
+    return(layer)
+
+
+def reduce_cells(reduce, values_sorted, cells, starts, n_cells):
+    '''
+        Reduce the values, sorted by cell, within each cell (NaN for cells without values)
+    '''
+    result = np.full(n_cells, np.nan)
+    if len(values_sorted):
+        result[cells] = reduce.reduceat(values_sorted, starts)
+    return(result)
+
+
+def raster_columns(var_name, layer, statistics=RASTER_STATISTICS):
+    '''
+        The statistics of the raster in each cell from its mergeable statistics
+        mean, max, min, sd (sample, as R), count (of values), fraction (of the
+        cell's pixels with values)
+        Cells without values are NaN (count and fraction are 0)
+        Return
+            Dictionary of column name ({varName}_{statistic}) to values of each cell
+    '''
+    count = layer['count']
+    results = dict(count=count, min=layer['min'], max=layer['max'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results['mean'] = layer['sum'] / count
+        results['sd'] = np.where(count > 1, np.sqrt(layer['m2'] / (count - 1)), np.nan)
+        results['fraction'] = np.where(layer['pixels'] > 0, count / layer['pixels'], 0)
+    return({'{}_{}'.format(var_name, stat): results[stat] for stat in statistics})
+
+
+def category_statistics(values, index, n_cells, pixel_area):
+    '''
+        Mergeable statistics of the categorical values within each cell
+        classes, area (m2, cells x classes), and pixels (the cell's pixels)
+    '''
+    cell = index['cell']
+    valid = (cell >= 0) & np.isfinite(values)
+    classes, class_index = np.unique(values[valid], return_inverse=True)
+    counts = np.bincount(cell[valid] * len(classes) + class_index, minlength=n_cells * len(classes))
+
+    layer = dict(classes=classes)
+    layer['area'] = counts.reshape(n_cells, len(classes)) * pixel_area
+    layer['pixels'] = np.bincount(cell[cell >= 0], minlength=n_cells).astype(np.float64)
+    layer['pixel_area'] = pixel_area
+    return(layer)
+
+
+def category_columns(var_name, layer, category_statistic='area'):
+    '''
+        Area (m2), or fraction of pixels, of each class in each cell
+        Return
+            Dictionary of column name ({varName}_{class}) to values of each cell
+    '''
+    values = layer['area']
+    if category_statistic == 'fraction':
+        pixels = layer['pixels'][:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.where(pixels > 0, values / layer['pixel_area'] / pixels, 0)
+    return({'{}_{:g}'.format(var_name, category): values[:, i] for i, category in enumerate(layer['classes'])})
+
+
+def coarsen_statistics(grid, area, layers, factor):
+    '''
+        Combine the statistics of factor x factor blocks of cells into the cells of
+        a grid factor times coarser, with the same top left corner
+        Return
+            grid, area, layers (see grid_statistics)
+    '''
+    grid_coarse = dict(grid, size=grid['size'] * factor,
+        n_col=-(-grid['n_col'] // factor), n_row=-(-grid['n_row'] // factor))
+    n_coarse = grid_coarse['n_row'] * grid_coarse['n_col']
+
+    # the coarse cell of each fine cell, and the fine cells sorted by coarse cell
+    row, col = np.divmod(np.arange(grid['n_row'] * grid['n_col']), grid['n_col'])
+    parent = (row // factor) * grid_coarse['n_col'] + col // factor
+    order = np.argsort(parent, kind='mergesort')
+    cells, starts = np.unique(parent[order], return_index=True)
+    def add(values):
+        return(np.bincount(parent, weights=values, minlength=n_coarse))
+
+    layers_coarse = list()
+    for var_name, data_type, layer in layers:
+        if data_type == 'areaLevel':
+            # sum the areas of each polygon in the fine cells of each coarse cell
+            n_polygons = len(layer['attributes'])
+            pairs, pair_index = np.unique(parent[layer['cell']] * n_polygons + layer['polygon'], return_inverse=True)
+            cell, polygon = np.divmod(pairs, n_polygons)
+            combined = dict(attributes=layer['attributes'], n_cells=n_coarse, cell=cell, polygon=polygon,
+                area=np.bincount(pair_index.ravel(), weights=layer['area'], minlength=len(pairs)))
+        elif data_type == 'polyIntersect':
+            combined = dict(area=add(layer['area']))
+        elif data_type == 'raster':
+            combined = dict(count=add(layer['count']), sum=add(layer['sum']), pixels=add(layer['pixels']))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean_fine = layer['sum'] / layer['count']
+                mean = combined['sum'] / combined['count']
+                # the squared deviations within the fine cells, plus those of the fine means
+                spread = np.where(layer['count'] > 0, layer['count'] * (mean_fine - mean[parent])**2, 0)
+            combined['m2'] = add(layer['m2']) + add(spread)
+            combined['min'] = reduce_cells(np.fmin, layer['min'][order], cells, starts, n_coarse)
+            combined['max'] = reduce_cells(np.fmax, layer['max'][order], cells, starts, n_coarse)
+        else:
+            combined = dict(classes=layer['classes'], pixels=add(layer['pixels']), pixel_area=layer['pixel_area'])
+            combined['area'] = np.stack([add(layer['area'][:, i]) for i in range(len(layer['classes']))], axis=1)
+        layers_coarse.append((var_name, data_type, combined))
+
+    return(grid_coarse, add(area), layers_coarse)
+
+
+if __name__ == '__main__':
+    main()
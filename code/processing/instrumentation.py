@@ -0,0 +1,237 @@
+'''
+Per-stage instrumentation of the processing
+
+Each stage (e.g. metadata, clip, lst, ndvi, nbdi, albedo, mean) is wrapped in
+stage(), which records its wall time, CPU time, bytes read and written, and its
+resident memory: at the start of the stage (rss_start_mb), the peak while it
+ran (rss_peak_mb, sampled every RSS_INTERVAL seconds by a thread) and the
+increase of the peak over the start (rss_delta_mb). The records are kept by the process that
+ran the stage until pop_records() - so pool workers return them with their
+results - and are saved as JSON lines by write_records and tabulated by
+summarize_records
+
+The CPU time, bytes read and written, and memory are of the whole process, not
+of the stage's own thread. So the work of any other thread of the process which
+overlaps the stage - e.g. the prefetch and write behind threads of
+L8_processing, which read the next window and write the last - is attributed to
+whichever stage is open at the time. The bytes are from /proc/self/io (or
+psutil, if it is installed) and are None where neither is available, as is the
+memory where neither /proc/self/statm nor psutil is
+process_max_rss_mb is the peak resident memory over the life of the process
+(ru_maxrss), so in a pool worker which has run other stages it is not the
+stage's own peak
+'''
+
+import os
+import sys
+import time
+import json
+import threading
+from contextlib import contextmanager
+import pandas as pd
+try:
+    import psutil
+except ImportError:
+    psutil = None
+import logging
+logger = logging.getLogger(__name__)
+
+STAGE_LOG = 'data/processed/stage_log.jsonl'
+
+# the records of the stages run by this process, until they are popped
+STAGE_RECORDS = list()
+# seconds between the samples of the resident memory during a stage
+RSS_INTERVAL = 0.05
+# the memory of a record (MB)
+MEMORY_FIELDS = ['rss_start_mb', 'rss_peak_mb', 'rss_delta_mb', 'process_max_rss_mb']
+
+
+@contextmanager
+def stage(name, **context):
+    '''
+        Record the stage's resource use
+        context: identifies the stage, e.g. city, landsat_product_id
+    '''
+    start = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    read_start, write_start = io_bytes()
+    sampler = RssSampler()
+    try:
+        yield
+    finally:
+        rss_start, rss_peak = sampler.stop()
+        read_end, write_end = io_bytes()
+        record = dict(stage=name)
+        record.update(context)
+        record.update(
+            pid = os.getpid(),
+            start = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)),
+            wall_s = time.perf_counter() - wall_start,
+            cpu_s = time.process_time() - cpu_start,
+            read_mb = None if read_start is None else (read_end - read_start) / 2**20,
+            write_mb = None if write_start is None else (write_end - write_start) / 2**20,
+            rss_start_mb = rss_start,
+            rss_peak_mb = rss_peak,
+            rss_delta_mb = None if rss_start is None else rss_peak - rss_start,
+            process_max_rss_mb = max_rss_mb(),
+            )
+        STAGE_RECORDS.append(record)
+        logger.debug('Stage {}: {:.2f} s wall, {:.2f} s cpu'.format(name, record['wall_s'], record['cpu_s']))
+
+
+class RssSampler(object):
+    '''
+        Sample the resident memory of the process in a thread, from its start until stop()
+    '''
+
+    def __init__(self, interval=RSS_INTERVAL):
+        self.start = rss_mb()
+        self.peak = self.start
+        self._done = threading.Event()
+        self._thread = None
+        if self.start is not None:
+            self._thread = threading.Thread(target=self._sample, args=(interval,), daemon=True)
+            self._thread.start()
+
+    def _sample(self, interval):
+        while not self._done.wait(interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def stop(self):
+        '''
+            Stop sampling
+            Return
+                The resident memory (MB) at the start, and the peak (None if unavailable)
+        '''
+        if self._thread is None:
+            return(None, None)
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_mb())
+        return(self.start, self.peak)
+
+
+def pop_records():
+    '''
+        Return and clear the records of this process
+    '''
+    records = list(STAGE_RECORDS)
+    del STAGE_RECORDS[:]
+    return(records)
+
+
+def merge_records(records):
+    '''
+        Combine the records of the same stage and context (e.g. of each window of
+        a scene) into one, summing the times and bytes, and keeping the memory at
+        the first start and the largest peak and increase
+        Return
+            List of records
+    '''
+    merged = dict()
+    for record in records:
+        key = tuple((k, v) for k, v in sorted(record.items()) if k not in
+            ['start', 'wall_s', 'cpu_s', 'read_mb', 'write_mb'] + MEMORY_FIELDS)
+        if key not in merged:
+            merged[key] = dict(record)
+            continue
+        total = merged[key]
+        for k in ['wall_s', 'cpu_s', 'read_mb', 'write_mb']:
+            if total[k] is not None and record[k] is not None:
+                total[k] += record[k]
+        for k in ['rss_peak_mb', 'rss_delta_mb', 'process_max_rss_mb']:
+            total[k] = max_or_none(total.get(k), record.get(k))
+    return(list(merged.values()))
+
+
+def max_or_none(a, b):
+    '''
+        The larger of a and b, ignoring None
+    '''
+    if a is None or b is None:
+        return(b if a is None else a)
+    return(max(a, b))
+
+
+def io_bytes():
+    '''
+        Bytes read and written by the process so far, or (None, None) if unavailable
+    '''
+    if os.path.exists('/proc/self/io'):
+        counters = dict()
+        with open('/proc/self/io', 'r') as fid:
+            for line in fid:
+                name, value = line.split(':')
+                counters[name] = int(value)
+        # read and write calls, which includes network file systems
+        return(counters['rchar'], counters['wchar'])
+    if psutil is not None:
+        counters = psutil.Process().io_counters()
+        return(counters.read_bytes, counters.write_bytes)
+    return(None, None)
+
+
+def rss_mb():
+    '''
+        The process's current resident memory (MB), or None if unavailable
+    '''
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm', 'r') as fid:
+            pages = int(fid.read().split()[1])
+        return(pages * os.sysconf('SC_PAGE_SIZE') / 2**20)
+    if psutil is not None:
+        return(psutil.Process().memory_info().rss / 2**20)
+    return(None)
+
+
+def max_rss_mb():
+    '''
+        The process's peak resident memory (MB) over its life, or None if unavailable
+    '''
+    try:
+        import resource
+    except ImportError:
+        # windows
+        if psutil is not None:
+            return(psutil.Process().memory_info().peak_wset / 2**20)
+        return(None)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    if sys.platform == 'darwin':
+        return(max_rss / 2**20)
+    return(max_rss / 2**10)
+
+
+def write_records(records, fn_log=STAGE_LOG, **context):
+    '''
+        Append the records to the JSON lines log
+        context: added to each record, e.g. the run
+    '''
+    with open(fn_log, 'a') as fid:
+        for record in records:
+            record = dict(record, **context)
+            fid.write(json.dumps(record) + '\n')
+
+
+def summarize_records(records):
+    '''
+        Tabulate the stages by city: the number of times run, the total and
+        maximum wall time, the total CPU time and bytes, and the largest peak
+        and increase of the memory during a stage
+        Return
+            Dataframe
+    '''
+    records = pd.DataFrame(records)
+    if 'city' not in records.columns:
+        records['city'] = None
+    records['city'] = records['city'].fillna('')
+    summary = records.groupby(['stage', 'city']).agg({
+        'wall_s': ['count', 'sum', 'max'],
+        'cpu_s': 'sum',
+        'read_mb': 'sum',
+        'write_mb': 'sum',
+        'rss_peak_mb': 'max',
+        'rss_delta_mb': 'max'})
+    summary.columns = ['n', 'wall_s', 'wall_s_max', 'cpu_s', 'read_mb', 'write_mb', 'rss_peak_mb', 'rss_delta_mb']
+    return(summary.sort_values('wall_s', ascending=False))
@@ -0,0 +1,187 @@
+'''
+Catalog of the Landsat scene metadata
+
+Every field of a scene's _MTL.txt (ODL) file is parsed once and kept in a
+SQLite database, along with the scene's row of data_source_satellite.csv, so
+the metadata of a scene, or the scenes to process or composite, is a query
+rather than a read of the text files
+
+Tables:
+        fields: landsat_product_id, group_name, field, value (text), number
+                (the value if it is numeric), mtime (of the MTL file when parsed)
+        scenes: the columns of data_source_satellite.csv, and the acquisition
+                date and time, sun elevation and azimuth, and cloud cover of the scene
+'''
+
+import os
+import sqlite3
+import pandas as pd
+import logging
+logger = logging.getLogger(__name__)
+
+CATALOG = 'data/processed/scene_catalog.sqlite'
+
+# the fields of the MTL file which are columns of the scenes table
+SCENE_FIELDS = {'date_acquired': 'DATE_ACQUIRED',
+                'scene_center_time': 'SCENE_CENTER_TIME',
+                'sun_elevation': 'SUN_ELEVATION',
+                'sun_azimuth': 'SUN_AZIMUTH',
+                'cloud_cover': 'CLOUD_COVER',
+                'cloud_cover_land': 'CLOUD_COVER_LAND'}
+
+
+def mtl_filename(city, landsat_product_id):
+    '''
+        Filename of the scene's metadata
+    '''
+    return('data/raw/{}/{}_MTL.txt'.format(city, landsat_product_id))
+
+
+def parse_mtl(fn_metadata):
+    '''
+        Parse the ODL metadata file
+        Return
+            List of (group, field, value) - the group is the innermost GROUP the
+            field is in, and the value is the text without quotes
+    '''
+    fields = list()
+    groups = list()
+    with open(fn_metadata, 'r') as fid:
+        for line in fid:
+            name, sep, value = line.partition('=')
+            name = name.strip()
+            if not sep:
+                # the END of the file, or a blank line
+                continue
+            value = value.strip()
+            if name == 'GROUP':
+                groups.append(value)
+            elif name == 'END_GROUP':
+                groups.pop()
+            else:
+                fields.append((groups[-1] if groups else '', name, value.strip('"')))
+    return(fields)
+
+
+def parse_number(value):
+    '''
+        The value as a float, or None if it is not numeric
+    '''
+    try:
+        return(float(value))
+    except ValueError:
+        return(None)
+
+
+def connect(fn_catalog=CATALOG):
+    '''
+        Open the catalog, creating the fields table if it is new
+    '''
+    con = sqlite3.connect(fn_catalog, timeout=60)
+    con.execute('''CREATE TABLE IF NOT EXISTS fields (
+        landsat_product_id TEXT, group_name TEXT, field TEXT, value TEXT, number REAL, mtime REAL)''')
+    con.execute('CREATE INDEX IF NOT EXISTS fields_scene ON fields (landsat_product_id, field)')
+    return(con)
+
+
+def index_scene(con, city, landsat_product_id):
+    '''
+        Parse the scene's metadata into the fields table, unless it is already
+        there and the MTL file has not been modified since
+        Return
+            True if the metadata was parsed
+    '''
+    fn_metadata = mtl_filename(city, landsat_product_id)
+    mtime = os.path.getmtime(fn_metadata)
+    indexed = con.execute('SELECT MAX(mtime) FROM fields WHERE landsat_product_id = ?',
+        (landsat_product_id,)).fetchone()[0]
+    if indexed is not None and indexed >= mtime:
+        return(False)
+
+    logger.info('Cataloging metadata: {}'.format(fn_metadata))
+    rows = [(landsat_product_id, group, field, value, parse_number(value), mtime)
+        for group, field, value in parse_mtl(fn_metadata)]
+    with con:
+        con.execute('DELETE FROM fields WHERE landsat_product_id = ?', (landsat_product_id,))
+        con.executemany('INSERT INTO fields VALUES (?, ?, ?, ?, ?, ?)', rows)
+    return(True)
+
+
+def update_catalog(source_satellite, fn_catalog=CATALOG):
+    '''
+        Catalog the metadata of each scene in data_source_satellite.csv (parsing only
+        new or modified MTL files) and rebuild the scenes table
+        Return
+            Dataframe of the scenes table
+    '''
+    con = connect(fn_catalog)
+    for index, info_satellite in source_satellite.iterrows():
+        index_scene(con, info_satellite['city'], info_satellite['landsat_product_id'])
+
+    # the scene level fields, one column each
+    placeholders = ', '.join('?' * len(SCENE_FIELDS))
+    fields = pd.read_sql_query('SELECT landsat_product_id, field, value, number FROM fields WHERE field IN ({})'.format(placeholders),
+        con, params=list(SCENE_FIELDS.values()))
+    fields['value'] = fields['number'].where(fields['number'].notnull(), fields['value'])
+    fields = fields.drop_duplicates(['landsat_product_id', 'field'])
+    fields = fields.pivot(index='landsat_product_id', columns='field', values='value')
+    fields = fields.reindex(columns=list(SCENE_FIELDS.values()))
+    fields = fields.rename(columns={field: column for column, field in SCENE_FIELDS.items()})
+
+    scenes = source_satellite.merge(fields, how='left', left_on='landsat_product_id', right_index=True)
+    scenes.to_sql('scenes', con, if_exists='replace', index=False)
+    con.close()
+
+    return(query_scenes(fn_catalog))
+
+
+def query_scenes(fn_catalog=CATALOG, city=None, day_night=None, include=None, start_date=None,
+        end_date=None, min_sun_elevation=None, max_cloud_cover=None):
+    '''
+        Select the scenes from the catalog
+        start_date and end_date are inclusive 'YYYY-MM-DD' limits on the acquisition date
+        Return
+            Dataframe of the scenes (see update_catalog)
+    '''
+    conditions = list()
+    params = list()
+    for column, operator, value in [('city', '=', city), ('day_night', '=', day_night),
+            ('include', '=', include), ('date_acquired', '>=', start_date),
+            ('date_acquired', '<=', end_date), ('sun_elevation', '>=', min_sun_elevation),
+            ('cloud_cover', '<=', max_cloud_cover)]:
+        if value is not None:
+            conditions.append('{} {} ?'.format(column, operator))
+            params.append(value)
+    query = 'SELECT * FROM scenes'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    con = connect(fn_catalog)
+    scenes = pd.read_sql_query(query, con, params=params)
+    con.close()
+    # sqlite keeps booleans as integers
+    if 'include' in scenes.columns:
+        scenes['include'] = scenes['include'].astype(bool)
+    return(scenes)
+
+
+def scene_metadata(landsat_product_id, fields=None, city=None, fn_catalog=CATALOG):
+    '''
+        The scene's metadata fields (all of them if fields is None)
+        If city is given, the scene is cataloged first if it is not already
+        Return
+            Dictionary of field to value - numeric values are floats
+    '''
+    con = connect(fn_catalog)
+    if city is not None:
+        index_scene(con, city, landsat_product_id)
+    query = 'SELECT field, value, number FROM fields WHERE landsat_product_id = ?'
+    params = [landsat_product_id]
+    if fields is not None:
+        fields = list(fields)
+        query += ' AND field IN ({})'.format(', '.join('?' * len(fields)))
+        params += fields
+    rows = con.execute(query, params).fetchall()
+    con.close()
+
+    return({field: value if number is None else number for field, value, number in rows})
@@ -0,0 +1,114 @@
+'''
+Spatial lag of the variables of a regular grid
+
+Python counterpart of spatialLag in discretiser.R. Rather than finding the
+neighbours of each cell in turn, the cells are placed in a 2-D array by their
+x/y indices (as in cnn/1-convert-csv-data-to-image-format.ipynb), and the
+neighbourhood mean of every variable is a sum of shifted copies of the array
+
+Neighbourhoods:
+        queen: the cells within radius cells in any direction (including diagonals),
+                so radius 1 is the 8 surrounding cells and larger radii are k-rings
+        rook: the cells within radius steps along the rows and columns, so radius 1
+                is the 4 adjacent cells
+The cell itself is not part of its neighbourhood. Neighbours which are masked
+(e.g. outside the city) or missing are ignored, and a cell without any
+neighbours with values is NaN
+'''
+
+import numpy as np
+
+# columns of the grid which are not variables (as the first four columns in discretiser.R)
+GRID_COLUMNS = ['x', 'y', 'cId', 'area']
+
+
+def spatial_lag(df, columns=None, kind='queen', radius=1, grid_size=None, mask=None, suffix='_sl'):
+    '''
+        Add the neighbourhood mean of each column as {column}{suffix}
+        columns: the variables to lag (default: the numeric columns other than
+            GRID_COLUMNS and existing lags)
+        grid_size: the cell size (default: the smallest spacing of x)
+        mask: boolean series, True for the cells which are neighbours (e.g. area > 0)
+        Return
+            Dataframe with the lag columns
+    '''
+    if columns is None:
+        columns = [column for column in df.select_dtypes(include=[np.number]).columns
+            if column not in GRID_COLUMNS and not column.endswith(suffix)]
+    x_index, y_index = grid_indices(df, grid_size)
+
+    values = df[columns].values.astype(np.float64)
+    if mask is not None:
+        values[~np.asarray(mask, dtype=bool)] = np.nan
+    grid = to_grid(values, x_index, y_index)
+    lagged = neighbourhood_mean(grid, neighbourhood(kind, radius))
+
+    df = df.copy()
+    lag_values = lagged[y_index, x_index]
+    for i, column in enumerate(columns):
+        df[column + suffix] = lag_values[:, i]
+    return(df)
+
+
+def grid_indices(df, grid_size=None):
+    '''
+        The integer column (x) and row (y) of each cell from its coordinates
+    '''
+    if grid_size is None:
+        # rounded, as the coordinates are saved in a csv
+        grid_size = np.diff(np.unique(np.round(df['x'].values, 3))).min()
+    x_index = np.round((df['x'].values - df['x'].min()) / grid_size).astype(int)
+    y_index = np.round((df['y'].values - df['y'].min()) / grid_size).astype(int)
+    return(x_index, y_index)
+
+
+def to_grid(values, x_index, y_index):
+    '''
+        Place the values (cells x variables) in an array (rows x columns x variables),
+        NaN where there is no cell
+    '''
+    grid = np.full((y_index.max() + 1, x_index.max() + 1, values.shape[1]), np.nan)
+    grid[y_index, x_index] = values
+    return(grid)
+
+
+def neighbourhood(kind='queen', radius=1):
+    '''
+        The (row, column) offsets of the neighbours of a cell
+    '''
+    offsets = list()
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if (dy, dx) == (0, 0):
+                continue
+            if kind == 'queen' or (kind == 'rook' and abs(dy) + abs(dx) <= radius):
+                offsets.append((dy, dx))
+    if not offsets:
+        raise ValueError('Unknown neighbourhood: {}'.format(kind))
+    return(offsets)
+
+
+def neighbourhood_mean(grid, offsets):
+    '''
+        Mean of the neighbours of each cell (offsets from neighbourhood), ignoring NaN
+        Return
+            Array the shape of grid
+    '''
+    n_row, n_col = grid.shape[:2]
+    radius = max(max(abs(dy), abs(dx)) for dy, dx in offsets)
+    # pad the edges so every shift is a slice of the same shape
+    padded = np.pad(grid, ((radius, radius), (radius, radius), (0, 0)), mode='constant',
+        constant_values=np.nan)
+    valid = np.isfinite(padded)
+    padded[~valid] = 0
+
+    total = np.zeros(grid.shape)
+    count = np.zeros(grid.shape)
+    for dy, dx in offsets:
+        rows = slice(radius + dy, radius + dy + n_row)
+        cols = slice(radius + dx, radius + dx + n_col)
+        total += padded[rows, cols]
+        count += valid[rows, cols]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return(np.where(count > 0, total / count, np.nan))
@@ -0,0 +1,188 @@
+'''
+Sky view factor (SVF) of a city's digital surface model (DSM)
+
+Python counterpart of calc_svf.R (horizon::svf with nAngles=10, maxDist=300)
+The DSM is split into tiles, each read with a halo wide enough for the search
+radius, and the tiles are calculated across a pool of processes
+
+Input:
+        data/intermediate/{city}/{city}_dsm_wgs_{res}.tif
+Output:
+        data/processed/{city}/{city}_svf_{res}.tif - a tiled GeoTIFF on the grid
+        of the DSM, as gridded by discretiser (varName svf in data_to_grid_{city}.csv)
+
+Notes:
+        The horizon angle in each direction is found by marching along the ray a
+        pixel at a time, for the whole tile at once, up to the search radius.
+        SVF = 1 - mean(sin(horizon angle)) over the directions (Zaksek et al., 2011),
+        with horizons below the horizontal taken as 0
+        For a DSM in degrees, the pixel size in metres is taken at the tile's latitude
+'''
+
+import numpy as np
+from osgeo import gdal
+from osgeo import osr
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# init logging
+import sys
+sys.path.append("code")
+from logger_config import *
+logger = logging.getLogger(__name__)
+
+# parameters as in calc_svf.R
+SVF_DIRECTIONS = 10
+SVF_MAX_DIST = 300
+SVF_TILE_SIZE = 1024
+SVF_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE', 'PREDICTOR=3']
+
+
+def main(cities=['bal','det','phx','por'], res='6', n_workers=4):
+    '''
+        Calculate the SVF of each city's DSM
+    '''
+    for city in cities:
+        fn_dsm = 'data/intermediate/{}/{}_dsm_wgs_{}.tif'.format(city, city, res)
+        fn_svf = 'data/processed/{}/{}_svf_{}.tif'.format(city, city, res)
+        calc_svf(fn_dsm, fn_svf, n_workers=n_workers)
+
+
+def calc_svf(fn_dsm, fn_svf, n_directions=SVF_DIRECTIONS, max_dist=SVF_MAX_DIST, tile_size=SVF_TILE_SIZE,
+        n_workers=4):
+    '''
+        Calculate the SVF of the DSM tile by tile across n_workers processes, and
+        save it as a tiled GeoTIFF
+        max_dist: search radius (m) of the horizon
+    '''
+    logger.info('Calculating the SVF of {}'.format(fn_dsm))
+    ds_dsm = gdal.Open(fn_dsm)
+    ds_out = gdal.GetDriverByName('GTiff').Create(fn_svf, ds_dsm.RasterXSize, ds_dsm.RasterYSize, 1,
+        gdal.GDT_Float32, options=SVF_CREATION_OPTIONS)
+    ds_out.SetGeoTransform(ds_dsm.GetGeoTransform())
+    ds_out.SetProjection(ds_dsm.GetProjection())
+    ds_out.GetRasterBand(1).SetNoDataValue(np.nan)
+
+    windows = list()
+    for yoff in range(0, ds_dsm.RasterYSize, tile_size):
+        for xoff in range(0, ds_dsm.RasterXSize, tile_size):
+            windows.append((xoff, yoff, min(tile_size, ds_dsm.RasterXSize - xoff),
+                min(tile_size, ds_dsm.RasterYSize - yoff)))
+
+    def write(done):
+        for future in done:
+            (xoff, yoff, xsize, ysize), svf = future.result()
+            ds_out.GetRasterBand(1).WriteArray(svf, xoff, yoff)
+
+    # keep a few tiles per worker in flight, so finished tiles do not pile up in memory
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        pending = set()
+        for i, window in enumerate(windows):
+            pending.add(pool.submit(svf_tile, fn_dsm, window, n_directions, max_dist))
+            if len(pending) >= 2 * n_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(done)
+            logger.debug('Submitted SVF tile {} of {}'.format(i + 1, len(windows)))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            write(done)
+
+    ds_out.FlushCache()
+    ds_out = None
+    logger.info('Saved {}'.format(fn_svf))
+
+
+def svf_tile(fn_dsm, window, n_directions=SVF_DIRECTIONS, max_dist=SVF_MAX_DIST):
+    '''
+        Calculate the SVF of a window of the DSM, reading it with a halo of the
+        search radius (NaN beyond the edges of the DSM)
+        Return
+            window, SVF array
+    '''
+    ds = gdal.Open(fn_dsm)
+    xoff, yoff, xsize, ysize = window
+    dx, dy = pixel_size_m(ds, yoff + ysize / 2)
+    halo_x = int(np.ceil(max_dist / dx))
+    halo_y = int(np.ceil(max_dist / dy))
+
+    # read the window and its halo, as far as the edges of the DSM
+    x0, y0 = max(xoff - halo_x, 0), max(yoff - halo_y, 0)
+    x1 = min(xoff + xsize + halo_x, ds.RasterXSize)
+    y1 = min(yoff + ysize + halo_y, ds.RasterYSize)
+    band = ds.GetRasterBand(1)
+    dsm = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0).astype(np.float64)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        dsm[dsm == nodata] = np.nan
+
+    # pad to the full halo
+    padded = np.full((ysize + 2 * halo_y, xsize + 2 * halo_x), np.nan)
+    padded[y0 - (yoff - halo_y):y1 - (yoff - halo_y), x0 - (xoff - halo_x):x1 - (xoff - halo_x)] = dsm
+
+    return(window, sky_view_factor(padded, halo_x, halo_y, dx, dy, n_directions, max_dist))
+
+
+def pixel_size_m(ds, row):
+    '''
+        The pixel width and height in metres (at the row's latitude if the DSM is in degrees)
+    '''
+    geotransform = ds.GetGeoTransform()
+    dx, dy = abs(geotransform[1]), abs(geotransform[5])
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    if srs.IsGeographic():
+        latitude = geotransform[3] + row * geotransform[5]
+        dx *= 111320 * np.cos(np.radians(latitude))
+        dy *= 110540
+    return(dx, dy)
+
+
+def sky_view_factor(padded, halo_x, halo_y, dx, dy, n_directions=SVF_DIRECTIONS, max_dist=SVF_MAX_DIST):
+    '''
+        SVF of the centre of the padded DSM (without the halos)
+        For each direction, the steepest elevation angle to the pixels along the ray
+        (within max_dist) is the horizon
+    '''
+    ysize = padded.shape[0] - 2 * halo_y
+    xsize = padded.shape[1] - 2 * halo_x
+    centre = padded[halo_y:halo_y + ysize, halo_x:halo_x + xsize]
+
+    sin_horizon = np.zeros(centre.shape)
+    tan_max = np.empty(centre.shape)
+    for direction in np.arange(n_directions) * 2 * np.pi / n_directions:
+        tan_max.fill(0)
+        for ox, oy, distance in ray_offsets(direction, dx, dy, max_dist):
+            shifted = padded[halo_y + oy:halo_y + oy + ysize, halo_x + ox:halo_x + ox + xsize]
+            # NaN (beyond the DSM) does not raise the horizon
+            np.fmax(tan_max, (shifted - centre) / distance, out=tan_max)
+        # sin(arctan(t)) = t / sqrt(1 + t^2)
+        sin_horizon += tan_max / np.sqrt(1 + tan_max**2)
+
+    svf = 1 - sin_horizon / n_directions
+    svf[np.isnan(centre)] = np.nan
+    return(svf.astype(np.float32))
+
+
+def ray_offsets(direction, dx, dy, max_dist):
+    '''
+        The pixel offsets (x, y) along the ray in the direction (radians, clockwise
+        from north), a pixel at a time, and their distance (m), up to max_dist
+    '''
+    offsets = list()
+    seen = set()
+    step = 1
+    while True:
+        ox = int(round(step * np.sin(direction)))
+        # rows increase to the south
+        oy = int(round(-step * np.cos(direction)))
+        distance = np.hypot(ox * dx, oy * dy)
+        if distance > max_dist:
+            break
+        if (ox, oy) not in seen and distance > 0:
+            seen.add((ox, oy))
+            offsets.append((ox, oy, distance))
+        step += 1
+    return(offsets)
+
+
+if __name__ == '__main__':
+    main()